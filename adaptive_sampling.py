@@ -0,0 +1,141 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Adaptive, confidence-driven sampling for color votes. Instead of classifying
+a fixed number of pixels, pixels are drawn in small batches and sampling stops
+once the leading color's margin over the runner-up is statistically settled
+(a one-sided test on the difference of two multinomial proportions), at a
+configurable confidence level and within minimum and maximum sample sizes.
+The confidence reached is returned, so ambiguous garments and segments can be
+flagged downstream.
+"""
+from collections import namedtuple
+
+import numpy as np
+from scipy.special import ndtr
+
+from segment_colors import summarize_histograms
+
+
+# color_id: the index of the winning color
+# confidence: how confident we are that it's ahead of the runner-up (0.5-1)
+# n_samples: the number of pixels classified
+# counts: the number of votes for each color
+ColorVote = namedtuple('ColorVote', ['color_id', 'confidence', 'n_samples',
+                                     'counts'])
+
+
+def margin_confidence(counts):
+
+    # for vote counts (... x colors), the confidence that the leading color's
+    # share is larger than the runner-up's. The difference of the two counts
+    # has a variance of n1 + n2 - (n1 - n2)^2 / n under the multinomial, so
+    # the confidence is the normal probability of the observed z score
+    counts = np.asarray(counts, dtype=float)
+    n = counts.sum(axis=-1)
+    ordered = np.sort(counts, axis=-1)
+    n1 = ordered[..., -1]
+    n2 = ordered[..., -2] if counts.shape[-1] > 1 else np.zeros_like(n1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = n1 + n2 - (n1 - n2) ** 2 / n
+        z = (n1 - n2) / np.sqrt(variance)
+
+    # a unanimous vote has no variance, and no votes has no confidence
+    z = np.where(variance > 0, z, np.inf)
+    z = np.where(n > 0, z, 0.0)
+
+    return ndtr(z)
+
+
+def sequential_vote(draw_batch, n_colors, confidence=0.95, min_samples=20,
+                    max_samples=400, batch_size=20):
+
+    # draw batches of color indices with draw_batch(size) until the leading
+    # color is settled, or max_samples have been drawn
+    counts = np.zeros(n_colors, dtype=np.int64)
+    n_samples = 0
+    reached = 0.0
+
+    while n_samples < max_samples:
+        size = min(batch_size, max_samples - n_samples)
+        counts += np.bincount(draw_batch(size), minlength=n_colors)
+        n_samples += size
+
+        reached = float(margin_confidence(counts))
+        if n_samples >= min_samples and reached >= confidence:
+            break
+
+    return ColorVote(int(counts.argmax()), reached, n_samples, counts)
+
+
+def adaptive_segment_colors(segment_map, image, color_lut, confidence=0.95,
+                            min_samples=20, max_samples=None,
+                            max_fraction=0.2, batch_fraction=0.02,
+                            random_state=None):
+
+    # sample pixels from the whole image in batches, with replacement, and
+    # keep only those in segments that aren't settled yet. A segment is
+    # settled when its color is, or when it has max_samples votes. Stop when
+    # every segment is settled, or max_fraction of the image has been drawn
+    if random_state is None:
+        random_state = np.random
+
+    segment_ids, segment_index = np.unique(segment_map.ravel(),
+                                           return_inverse=True)
+    pixels = image.reshape(-1, 3)
+    n_pixels = len(pixels)
+    n_segments = len(segment_ids)
+    n_colors = len(color_lut.class_names)
+
+    histograms = np.zeros((n_segments, n_colors), dtype=np.int64)
+    settled = np.zeros(n_segments, dtype=bool)
+    batch_size = max(int(n_pixels * batch_fraction), 1)
+    max_draws = max(int(n_pixels * max_fraction), batch_size)
+
+    drawn = 0
+    while drawn < max_draws and not settled.all():
+        sampled = random_state.randint(0, n_pixels, batch_size)
+        sampled = sampled[~settled[segment_index[sampled]]]
+        drawn += batch_size
+
+        # keep no more of a segment's pixels than it has room for, in the
+        # order they were drawn
+        if max_samples is not None:
+            sampled_index = segment_index[sampled]
+            order = np.argsort(sampled_index, kind='mergesort')
+            ordered_index = sampled_index[order]
+            rank = np.empty(len(sampled), dtype=np.int64)
+            rank[order] = (np.arange(len(sampled)) -
+                           np.searchsorted(ordered_index, ordered_index))
+            room = max_samples - histograms.sum(axis=1)
+            sampled = sampled[rank < room[sampled_index]]
+
+        joint_index = (segment_index[sampled].astype(np.int64) * n_colors +
+                       color_lut.classify_ids(pixels[sampled]))
+        histograms += np.bincount(
+                joint_index, minlength=n_segments * n_colors).reshape(
+                        n_segments, n_colors)
+
+        confidences = margin_confidence(histograms)
+        n_votes = histograms.sum(axis=1)
+        settled = (n_votes >= min_samples) & (confidences >= confidence)
+        if max_samples is not None:
+            settled |= n_votes >= max_samples
+
+    # segments too small to get min_samples votes are counted in full
+    too_few = histograms.sum(axis=1) < min_samples
+    if too_few.any():
+        in_small_segment = too_few[segment_index]
+        joint_index = (segment_index[in_small_segment].astype(np.int64) *
+                       n_colors +
+                       color_lut.classify_ids(pixels[in_small_segment]))
+        full_counts = np.bincount(
+                joint_index, minlength=n_segments * n_colors).reshape(
+                        n_segments, n_colors)
+        histograms[too_few] = full_counts[too_few]
+
+    # summarize the votes like label_segment_colors does
+    segment_colors = summarize_histograms(segment_ids, histograms)
+
+    return segment_colors, margin_confidence(histograms)
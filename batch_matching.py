@@ -0,0 +1,159 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A batch version of 'charmony_run' for scoring many (garment, closet) pairs
+with one or both matching methods. Each distinct garment and closet image is
+decoded, color corrected and analyzed only once, the work is spread across a
+pool of worker processes (each holding its own CharmonyEngine), and results
+are yielded as they finish. Garment colors are drawn from seeded random
+states, so batch results are reproducible and equal to
+'CharmonyEngine.match(..., seed=seed)'.
+"""
+from collections import namedtuple
+from multiprocessing import Pool
+
+from charmony_engine import CharmonyEngine
+
+
+# garment_index / closet_index: positions in the garments and closets lists
+# method: the color matching method ('complement' or 'triad')
+# garment_color: the color of the garment
+# matching_colors: the colors that match the garment
+# image: the closet image with the matching colors highlighted (or None)
+BatchMatch = namedtuple('BatchMatch', ['garment_index', 'closet_index',
+                                       'method', 'garment_color',
+                                       'matching_colors', 'image'])
+
+# the engine of each worker process
+_worker_engine = None
+
+
+def _init_worker(engine_options):
+
+    global _worker_engine
+    _worker_engine = CharmonyEngine(**engine_options)
+
+
+def _analyze_garment(task):
+
+    garment_key, garment, seed = task
+    return garment_key, _worker_engine.analyze_garment(garment, seed)
+
+
+def _match_closet(task):
+
+    # analyze the closet once, then highlight it for every garment color and
+    # method paired with it (rendering each distinct set of matching colors
+    # only once)
+    closet, matches, render, seed = task
+    engine = _worker_engine
+
+    analysis = engine.analyze_closet(closet, seed=seed)
+
+    images = {}
+    results = []
+    for garment_index, closet_index, method, garment_color in matches:
+        matching_colors = engine.matching_colors(garment_color, method)
+
+        image = None
+        if render:
+            key = tuple(sorted(matching_colors))
+            if key not in images:
+                images[key] = engine.highlight(analysis.image,
+                                               analysis.segment_map,
+                                               analysis.segment_colors,
+                                               matching_colors)
+            image = images[key]
+
+        results.append(BatchMatch(garment_index, closet_index, method,
+                                  garment_color, matching_colors, image))
+
+    return results
+
+
+def _image_key(image):
+
+    # identify file paths by the path, and in-memory arrays by the object
+    if isinstance(image, (str, type(u''))):
+        return image
+    return id(image)
+
+
+def _run_tasks(pool, function, tasks):
+
+    # run the tasks in the pool (in any order), or in this process
+    if pool is None:
+        return (function(task) for task in tasks)
+    return pool.imap_unordered(function, tasks)
+
+
+def batch_match(garments, closets, methods=('complement', 'triad'),
+                pairs=None, processes=None, seed=0, render=True,
+                **engine_options):
+
+    # by default, match every garment against every closet
+    if pairs is None:
+        pairs = [(garment_index, closet_index)
+                 for garment_index in range(len(garments))
+                 for closet_index in range(len(closets))]
+
+    ##################################################
+    ### FIND THE DISTINCT GARMENT AND CLOSET IMAGES ###
+    ##################################################
+
+    garment_keys = [_image_key(garment) for garment in garments]
+    closet_keys = [_image_key(closet) for closet in closets]
+
+    unique_garments = {}
+    unique_closets = {}
+    for garment_index, closet_index in pairs:
+        unique_garments.setdefault(garment_keys[garment_index],
+                                   garments[garment_index])
+        unique_closets.setdefault(closet_keys[closet_index],
+                                  closets[closet_index])
+
+    # work in this process if asked for a single process, otherwise start a
+    # pool of workers, each loading its own engine
+    if processes == 1:
+        _init_worker(engine_options)
+        pool = None
+    else:
+        # the pool already keeps the cores busy, so by default each worker's
+        # engine runs single-threaded, OpenCV included
+        engine_options.setdefault('threads', 1)
+        engine_options.setdefault('opencv_threads', 1)
+        pool = Pool(processes, initializer=_init_worker,
+                    initargs=(engine_options,))
+
+    try:
+        ###########################################
+        ### DETERMINE THE COLOR OF EACH GARMENT ###
+        ###########################################
+
+        garment_colors = dict(_run_tasks(
+                pool, _analyze_garment,
+                [(key, garment, seed) for key, garment in
+                 unique_garments.items()]))
+
+        ###############################################################
+        ### ANALYZE EACH CLOSET ONCE AND HIGHLIGHT ALL OF ITS PAIRS ###
+        ###############################################################
+
+        closet_matches = dict((key, []) for key in unique_closets)
+        for garment_index, closet_index in pairs:
+            for method in methods:
+                closet_matches[closet_keys[closet_index]].append(
+                        (garment_index, closet_index, method,
+                         garment_colors[garment_keys[garment_index]]))
+
+        tasks = [(unique_closets[key], closet_matches[key], render, seed)
+                 for key in unique_closets]
+
+        for results in _run_tasks(pool, _match_closet, tasks):
+            for result in results:
+                yield result
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A benchmark of each stage of the color matching pipeline (decode, resize,
+color correction, seed sampling, segmentation, segment labeling and
+compositing) on synthetic garment and closet images at several resolutions
+and segment counts. A stand-in nearest color classifier replaces
+'color_detector.pkl', so the benchmark runs anywhere. Each run reports
+throughput, latency percentiles and peak memory per stage, and can be saved
+as a baseline and compared against one, failing if any stage got slower than
+the regression threshold allows.
+
+    python benchmark.py --sizes 1200x800,4000x3000 --segments 100,350
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json --threshold 0.2
+"""
+import ctypes
+import json
+import sys
+import time
+
+import numpy as np
+from cv2 import imdecode, imencode
+
+from charmony_engine import CharmonyEngine
+from color_correction import fix_color
+from color_lookup import build_color_lut
+from image_io import decode_flag
+from instrumentation import peak_rss, reset_peak_rss
+from resize_image import resize_image
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# glibc, to hand freed memory back to the system before a stage's resident
+# size is measured (otherwise the stage may reuse it without growing)
+try:
+    libc = ctypes.CDLL('libc.so.6')
+except OSError:
+    libc = None
+
+
+# the stages timed for every image size and segment count, in pipeline order
+stages = ['decode', 'resize', 'color_correction', 'seed_sampling',
+          'segmentation', 'segment_labeling', 'compositing']
+
+# the Red Green Blue centers of the colors the stand-in classifier knows
+stand_in_colors = {'red': (255, 0, 0),
+                   'yellow': (255, 255, 0),
+                   'green': (0, 255, 0),
+                   'cyan': (0, 255, 255),
+                   'blue': (0, 0, 255),
+                   'magenta': (255, 0, 255),
+                   'black': (0, 0, 0),
+                   'brown': (140, 80, 30),
+                   'grey': (128, 128, 128),
+                   'white': (255, 255, 255)}
+
+
+class NearestColorClassifier(object):
+
+    # a stand-in for the pickled K-Nearest Neighbor color classifier, which
+    # predicts the color whose center is closest to each Red Green Blue value
+    def __init__(self, colors=stand_in_colors):
+        self.classes_ = np.array(sorted(colors))
+        self.centers = np.array([colors[name] for name in self.classes_],
+                                dtype=float)
+
+    def predict(self, pixels):
+        pixels = np.asarray(pixels, dtype=float).reshape(-1, 3)
+        distances = ((pixels[:, np.newaxis, :] -
+                      self.centers[np.newaxis, :, :]) ** 2).sum(axis=2)
+        return self.classes_[distances.argmin(axis=1)]
+
+
+###################################
+### GENERATING SYNTHETIC IMAGES ###
+###################################
+
+def synthetic_garment(width, height, random_state):
+
+    # a solid colored garment in the middle of a grey ramp background
+    ramp = np.linspace(0, 255, width).astype(np.uint8)
+    image = np.repeat(np.repeat(ramp[np.newaxis, :, np.newaxis], height, 0),
+                      3, 2)
+    image[height // 6:5 * height // 6, width // 5:4 * width // 5] = \
+        (200, 40, 40)
+    noise = random_state.randint(-12, 12, image.shape)
+
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def synthetic_closet(width, height, random_state, n_garments=12):
+
+    # a row of garments of random colors, with a shelf and some noise
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    edges = np.linspace(0, width, n_garments + 1).astype(int)
+    colors = random_state.randint(0, 256, (n_garments, 3))
+    for garment in np.arange(n_garments):
+        image[:, edges[garment]:edges[garment + 1]] = colors[garment]
+    image[:height // 10] = (90, 60, 30)
+    noise = random_state.randint(-20, 20, image.shape)
+
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def encode(image):
+
+    # encode an image as a JPEG, as uploads arrive
+    return imencode('.jpg', image[:, :, ::-1])[1]
+
+
+#################################
+### MEASURING TIME AND MEMORY ###
+#################################
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.latencies = dict((stage, []) for stage in stages)
+        self.peak_memory = dict((stage, None) for stage in stages)
+
+        # while measuring_memory is set, calls measure memory and aren't
+        # timed, so the timings don't include any tracing overhead
+        self.measuring_memory = False
+
+    def run(self, stage, function, *args, **kwargs):
+
+        if self.measuring_memory:
+            return self.measure(stage, function, *args, **kwargs)
+
+        # time one call of a stage
+        start = time.time()
+        result = function(*args, **kwargs)
+        self.latencies[stage].append(time.time() - start)
+
+        return result
+
+    def measure(self, stage, function, *args, **kwargs):
+
+        # measure the peak allocation of one call of a stage with tracemalloc
+        # where it's available, or else by how much the process's peak
+        # resident size grew. Where the peak can't be reset (outside Linux),
+        # this misses memory reused below an earlier peak
+        if tracemalloc is not None:
+            tracemalloc.start()
+        else:
+            if libc is not None:
+                libc.malloc_trim(0)
+            reset_peak_rss()
+            start_rss = peak_rss()
+
+        result = function(*args, **kwargs)
+
+        if tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            peak = peak_rss() - start_rss
+        self.peak_memory[stage] = max(self.peak_memory[stage] or 0, peak)
+
+        return result
+
+
+def summarize(latencies, peak_memory):
+
+    latencies = np.array(latencies)
+    return {'throughput': 1.0 / latencies.mean(),
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'peak_memory': peak_memory}
+
+
+#############################
+### RUNNING THE BENCHMARK ###
+#############################
+
+def benchmark_case(engine, width, height, n_segments, repeats, seed=0):
+
+    random_state = np.random.RandomState(seed)
+    garment = encode(synthetic_garment(width, height, random_state))
+    closet = encode(synthetic_closet(width, height, random_state))
+
+    engine.n_segments = n_segments
+    timer = StageTimer()
+
+    # the first pass measures memory (and warms up), the rest are timed
+    for repeat in np.arange(repeats + 1):
+        timer.measuring_memory = repeat == 0
+        images = []
+        for encoded_image in (garment, closet):
+            image = timer.run('decode', imdecode, encoded_image,
+                              decode_flag(encoded_image, engine.image_width))
+            image = timer.run('resize', resize_image, image,
+                              engine.image_width)[:, :, ::-1]
+            image = timer.run('color_correction', fix_color, image,
+                              engine.percentile_correction,
+                              edge_filter=engine.edge_filter)
+            images.append(image)
+        image_to_match_to, image_of_possible_matches = images
+
+        garment_color = timer.run('seed_sampling', engine.garment_color,
+                                  image_to_match_to, random_state)
+        matching_colors = engine.matching_colors(garment_color, 'complement')
+
+        segment_map = timer.run('segmentation', engine.segment_image,
+                                image_of_possible_matches)
+        segment_colors = timer.run('segment_labeling', engine.label_segments,
+                                   image_of_possible_matches, segment_map)
+        timer.run('compositing', engine.highlight, image_of_possible_matches,
+                  segment_map, segment_colors, matching_colors)
+
+    return dict((stage, summarize(timer.latencies[stage],
+                                  timer.peak_memory[stage]))
+                for stage in stages)
+
+
+def run_benchmark(sizes, segment_counts, repeats=5, bits_per_channel=6):
+
+    color_lut = build_color_lut(NearestColorClassifier(), bits_per_channel)
+    engine = CharmonyEngine(color_lut=color_lut)
+
+    results = {}
+    for width, height in sizes:
+        for n_segments in segment_counts:
+            case = '%dx%d/%d' % (width, height, n_segments)
+            results[case] = benchmark_case(engine, width, height, n_segments,
+                                           repeats)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+
+    # flag every stage whose median latency grew by more than threshold
+    regressions = []
+    for case in sorted(results):
+        if case not in baseline:
+            continue
+        for stage in stages:
+            current = results[case][stage]['p50']
+            previous = baseline[case][stage]['p50']
+            if current > previous * (1.0 + threshold):
+                regressions.append((case, stage, previous, current))
+
+    return regressions
+
+
+def print_results(results):
+
+    # per stage peak memory is traced allocation with tracemalloc (Python
+    # 3), or the growth of the process's peak resident size (Python 2)
+    print('%-16s %-18s %10s %9s %9s %9s %12s' %
+          ('case', 'stage', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms',
+           'peak KiB'))
+    for case in sorted(results):
+        for stage in stages:
+            summary = results[case][stage]
+            peak_memory = '-'
+            if summary['peak_memory'] is not None:
+                peak_memory = str(summary['peak_memory'] // 1024)
+            print('%-16s %-18s %10.1f %9.2f %9.2f %9.2f %12s' %
+                  (case, stage, summary['throughput'], 1000 * summary['p50'],
+                   1000 * summary['p90'], 1000 * summary['p99'],
+                   peak_memory))
+    print('process peak resident memory: %d MiB' % (peak_rss() // 2 ** 20))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark each stage of '
+                                                 'the cHarmony pipeline.')
+    parser.add_argument('--sizes', default='800x600,1600x1200,4000x3000',
+                        help='comma separated WIDTHxHEIGHT closet sizes')
+    parser.add_argument('--segments', default='100,350',
+                        help='comma separated SLIC segment counts')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--baseline', help='json baseline to compare with')
+    parser.add_argument('--save-baseline', help='save the results as json')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown of a stage (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(side) for side in size.split('x'))
+             for size in args.sizes.split(',')]
+    segment_counts = [int(count) for count in args.segments.split(',')]
+
+    results = run_benchmark(sizes, segment_counts, args.repeats)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as handle:
+            json.dump(results, handle, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, args.threshold)
+        for case, stage, previous, current in regressions:
+            print('REGRESSION %s %s: %.2f ms -> %.2f ms' %
+                  (case, stage, 1000 * previous, 1000 * current))
+        if regressions:
+            sys.exit(1)
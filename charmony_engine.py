@@ -0,0 +1,659 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A long-lived color matching engine. The color lookup table (built from
+'color_detector.pkl'), the color and rotation lookup dicts, and the matching
+colors for every color and matching method are loaded once, so repeated calls
+to 'match' only pay for the image work. Images can be given as file paths or
+as encoded bytes, buffers or in-memory Red Green Blue uint8 arrays.
+"""
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from cv2 import getNumThreads, setNumThreads
+from PIL import Image
+
+from adaptive_sampling import adaptive_segment_colors, sequential_vote, \
+    ColorVote, margin_confidence
+from closet_cache import ClosetAnalysis, cache_key, image_digest
+from color_lookup import load_color_lut
+from color_correction import fix_color
+from color_wheel_rotator import rotate_colors
+from frame_streaming import match_frames
+from highlight import highlight_segments
+from image_io import load_image, read_bytes
+from instrumentation import Instrumentation, null_instrumentation
+from match_result import MatchResult
+from region_merging import merge_regions
+from segment_colors import label_segment_colors, segment_color_names
+from segmentation import default_segments_per_megapixel, segment_image
+from tiled_processing import analyze_closet_tiled, highlight_tiled, \
+    tile_size_for_budget
+
+
+# define the Red Green Blue profiles centers for each possible color
+color_dict = {'red': (255, 0, 0),
+              'yellow': (255, 255, 0),
+              'green': (0, 255, 0),
+              'cyan': (0, 255, 255),
+              'blue': (0, 0, 255),
+              'magenta': (255, 0, 255)}
+
+# the neutral colors, which match with every non-neutral color
+neutral_colors = ['black', 'brown', 'grey', 'white']
+
+# define what degree rotation corresponds to each method of matching colors
+match_rotation_dict = {'complement': 180,
+                       'triad': 120}
+
+
+def find_matching_colors(color, how_to_match_colors):
+
+    # If color is a neutral color, return all possible non-neutral colors
+    if color in neutral_colors:
+        return ['red', 'yellow', 'green', 'cyan', 'blue', 'magenta']
+
+    # else, use a function to rotate the color wheel, based on the current
+    # Red Green Blue profile (looked up in color_dict) and the degree rotaiton
+    # from how_to_match_colors (looked up in match_rotation_dict)
+    color_rbg_profile = color_dict[color]
+    matching_rotation = match_rotation_dict[how_to_match_colors]
+    matching_color_list = rotate_colors(color_rbg_profile, matching_rotation)
+
+    # ensure the matching_color_list outputs (lists formatted as Red Green Blue
+    # profiles) are all unique
+    unique_matching_color_values = list()
+    for sublist in matching_color_list:
+        if sublist not in unique_matching_color_values:
+            unique_matching_color_values.append(sublist)
+
+    # convert tuples in Red Green Blue color format back to color names
+    return [name for name in color_dict if color_dict[name] in
+            tuple(tuple(rbg) for rbg in unique_matching_color_values)]
+
+
+def seeded_state(seed, digest):
+
+    # combine a user seed with an image hash into a 32-bit RandomState seed
+    return (int(digest[:8], 16) ^ int(seed)) & 0xffffffff
+
+
+class CharmonyEngine(object):
+
+    def __init__(self, model_path='color_detector.pkl', lut_path=None,
+                 bits_per_channel=6, image_width=600, percentile_correction=10,
+                 n_segments=None, compactness=10, sigma=1, dim_factor=0.85,
+                 edge_filter='bilateral', reduced_decode=True,
+                 closet_cache=None, color_lut=None, sampling='fixed',
+                 confidence=0.95, min_samples=20, max_samples=400,
+                 segmentation='full', segmentation_scale=0.5,
+                 segments_per_megapixel=None, segmentation_backend='slic',
+                 refine_edges=True, merge_regions=False,
+                 merge_threshold=0.7, merge_same_color=True, threads=None,
+                 opencv_threads=None, trace_memory=False):
+
+        # load the lookup table precomputed from the pickled model (rebuilt
+        # automatically if the model has changed), unless a ready made
+        # ColorLookupTable is given
+        if color_lut is None:
+            color_lut = load_color_lut(model_path, lut_path, bits_per_channel)
+        self.color_detector = color_lut
+
+        self.image_width = image_width
+        self.percentile_correction = percentile_correction
+        self.edge_filter = edge_filter
+        self.reduced_decode = reduced_decode
+        self.compactness = compactness
+        self.sigma = sigma
+
+        # 'full' segments the closet image at full resolution, while
+        # 'coarse' segments a copy downscaled by segmentation_scale and
+        # upsamples the labels (see segmentation.py). Either way, the number
+        # of segments scales with the image area (segments_per_megapixel, by
+        # default 1500) unless a fixed n_segments is given
+        self.n_segments = n_segments
+        self.segmentation = segmentation
+        self.segmentation_scale = segmentation_scale
+        self.segments_per_megapixel = segments_per_megapixel
+        self.segmentation_backend = segmentation_backend
+        self.refine_edges = refine_edges
+        self.dim_factor = dim_factor
+
+        # with merge_regions, neighbouring segments whose color histograms
+        # are at least merge_threshold alike (and, with merge_same_color,
+        # have the same most frequent color) are merged into regions that
+        # pool their votes (see region_merging.py)
+        self.merge_regions = merge_regions
+        self.merge_threshold = merge_threshold
+        self.merge_same_color = merge_same_color
+
+        # 'fixed' classifies 400 garment pixels and every closet pixel, while
+        # 'adaptive' samples in batches until the leading color is settled
+        # at the given confidence (see adaptive_sampling.py), drawing between
+        # min_samples and max_samples pixels for the garment and for each
+        # closet segment (segments smaller than min_samples are counted whole)
+        self.sampling = sampling
+        self.confidence = confidence
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+
+        # an optional ClosetCache of analyzed closet images
+        self.closet_cache = closet_cache
+
+        # whether the stats asked for with return_stats include the peak
+        # memory of each stage (see instrumentation.py)
+        self.trace_memory = trace_memory
+
+        # the thread budget of a single match. With 2 or more threads, the
+        # garment is analyzed on a helper thread while the closet is loaded,
+        # corrected and segmented. None (or 1) runs the two one after the
+        # other. Close the engine (or use it in a with block) to stop the
+        # helper thread
+        self.threads = threads
+        self.helper_pool = None
+
+        # OpenCV's own thread pool is process-wide, so it's only resized if
+        # opencv_threads is given (e.g. 1 when running many engines in
+        # parallel processes), and put back as it was when the engine closes
+        self.opencv_threads = opencv_threads
+        self.previous_opencv_threads = None
+        if opencv_threads is not None:
+            self.previous_opencv_threads = getNumThreads()
+            setNumThreads(opencv_threads)
+
+        # work out the matching colors for every color and matching method
+        # up front, so matching is a dict lookup
+        self.matching_colors_dict = {}
+        for color in self.color_detector.class_names:
+            for how_to_match_colors in match_rotation_dict:
+                if color in color_dict or color in neutral_colors:
+                    self.matching_colors_dict[(color, how_to_match_colors)] = \
+                        find_matching_colors(color, how_to_match_colors)
+
+    def close(self):
+
+        # stop the helper thread, and give OpenCV back its thread count
+        if self.helper_pool is not None:
+            self.helper_pool.terminate()
+            self.helper_pool.join()
+            self.helper_pool = None
+        if self.previous_opencv_threads is not None:
+            setNumThreads(self.previous_opencv_threads)
+            self.previous_opencv_threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    ###################################
+    ### LOADING AND CLEANING IMAGES ###
+    ###################################
+
+    def read_image(self, image):
+
+        # read an image file into a 1-D uint8 array of its encoded bytes, so
+        # it can be hashed and decoded without reading the file twice
+        return read_bytes(image)
+
+    def load_image(self, image, instrumentation=null_instrumentation):
+
+        # decode an encoded image (at a reduced scale for large photos) and
+        # resize it to the engine's width, or resize an in-memory Red Green
+        # Blue array, then correct the color balance by defining the low and
+        # high precentile value
+        with instrumentation.stage('load'):
+            image = load_image(image, target_width=self.image_width,
+                               reduced_decode=self.reduced_decode)
+
+        with instrumentation.stage('color_correction'):
+            image = fix_color(image,
+                              percentile_correction=self.percentile_correction,
+                              edge_filter=self.edge_filter)
+        instrumentation.count('images_loaded')
+
+        return image
+
+    ##########################################################
+    ### DETNERMINING THE COLOR OF THE CLOTHING TO MATCH TO ###
+    ##########################################################
+
+    def garment_vote(self, image_to_match_to, random_state=None,
+                     instrumentation=null_instrumentation):
+
+        # sample with the given numpy RandomState, or numpy's global one
+        if random_state is None:
+            random_state = np.random
+
+        # Determine the pixel boundaries of image_to_match_to, and the
+        # center of the image to draw random points from
+        max_dim1_percent = image_to_match_to.shape[0] / 100.0
+        max_dim2_percent = image_to_match_to.shape[1] / 100.0
+        dim1_range = np.arange(max_dim1_percent * 40, max_dim1_percent * 60, 1)
+        dim2_range = np.arange(max_dim2_percent * 40, max_dim2_percent * 60, 1)
+
+        def draw_batch(size):
+            # Predict the color of a batch of random points at once
+            dim1_coords = random_state.choice(dim1_range, size).astype(int)
+            dim2_coords = random_state.choice(dim2_range, size).astype(int)
+            instrumentation.count('predict_calls')
+            return self.color_detector.classify_ids(
+                    image_to_match_to[dim1_coords, dim2_coords, :])
+
+        n_colors = len(self.color_detector.class_names)
+        if self.sampling == 'adaptive':
+            # draw small batches until the leading color is settled
+            vote = sequential_vote(draw_batch, n_colors, self.confidence,
+                                   self.min_samples, self.max_samples)
+        else:
+            # select 400 random points from the center of the image
+            counts = np.bincount(draw_batch(400), minlength=n_colors)
+            vote = ColorVote(int(counts.argmax()),
+                             float(margin_confidence(counts)), 400, counts)
+
+        instrumentation.count('garment_sample_size', vote.n_samples)
+        instrumentation.count('pixels_classified', vote.n_samples)
+        instrumentation.gauge('garment_confidence', vote.confidence)
+
+        return vote
+
+    def garment_color(self, image_to_match_to, random_state=None,
+                      instrumentation=null_instrumentation):
+
+        # the most frequent color among the random points
+        vote = self.garment_vote(image_to_match_to, random_state,
+                                 instrumentation)
+
+        return self.color_detector.class_names[vote.color_id]
+
+    def analyze_garment(self, garment, seed=None,
+                        instrumentation=null_instrumentation):
+
+        # load the garment image and determine its color. With a seed, the
+        # random points are drawn from a RandomState derived from the seed and
+        # the image content, so the result is the same wherever (and in
+        # whatever order) the garment is analyzed
+        garment = self.read_image(garment)
+
+        random_state = None
+        if seed is not None:
+            random_state = np.random.RandomState(
+                    seeded_state(seed, image_digest(garment)))
+
+        image_to_match_to = self.load_image(garment, instrumentation)
+
+        with instrumentation.stage('garment_sampling'):
+            return self.garment_color(image_to_match_to, random_state,
+                                      instrumentation)
+
+    ###################################################
+    ### DETERMINING THE APPROPRIATE MATCHING COLOR  ###
+    ### Note: only supports matching to one color   ###
+    ###################################################
+
+    def matching_colors(self, color, how_to_match_colors):
+
+        key = (color, how_to_match_colors)
+        if key not in self.matching_colors_dict:
+            self.matching_colors_dict[key] = find_matching_colors(
+                    color, how_to_match_colors)
+
+        return list(self.matching_colors_dict[key])
+
+    ##################################################################
+    ### SEGMENT THE CLOSET IMAGE AND DETERMINE THE SEGMENT COLORS  ###
+    ##################################################################
+
+    def segmentation_options(self):
+
+        # the options of segmentation.segment_image, other than the number
+        # of segments
+        options = {'mode': self.segmentation,
+                   'scale': self.segmentation_scale,
+                   'backend': self.segmentation_backend,
+                   'refine': self.refine_edges}
+        if self.segmentation_backend == 'slic':
+            options.update(compactness=self.compactness, sigma=self.sigma)
+
+        return options
+
+    def segment_image(self, image_of_possible_matches):
+
+        # Use Simple Linear Itterative Clustering (or another superpixel
+        # backend) to segment the closet image
+        return segment_image(image_of_possible_matches,
+                             n_segments=self.n_segments,
+                             segments_per_megapixel=
+                             self.segments_per_megapixel,
+                             **self.segmentation_options())
+
+    def label_segments(self, image_of_possible_matches,
+                       segmented_possible_matches,
+                       instrumentation=null_instrumentation,
+                       random_state=None):
+
+        if self.sampling == 'adaptive':
+            # sample each segment's pixels until its color is settled (with
+            # the given numpy RandomState, or numpy's global one)
+            segment_colors, confidences = adaptive_segment_colors(
+                    segmented_possible_matches, image_of_possible_matches,
+                    self.color_detector, self.confidence, self.min_samples,
+                    self.max_samples, random_state=random_state)
+            instrumentation.count('pixels_classified',
+                                  int(segment_colors.pixel_counts.sum()))
+            instrumentation.count('ambiguous_segments',
+                                  int((confidences < self.confidence).sum()))
+        else:
+            # Classify every pixel of the closet image once, then count the
+            # colors within all segments at the same time
+            closet_color_map = self.color_detector.classify_image(
+                    image_of_possible_matches)
+            segment_colors = label_segment_colors(
+                    segmented_possible_matches, closet_color_map,
+                    len(self.color_detector.class_names))
+            instrumentation.count('pixels_classified', closet_color_map.size)
+
+        instrumentation.count('predict_calls')
+        instrumentation.count('segments', len(segment_colors.segment_ids))
+
+        return segment_colors
+
+    def segment_closet(self, image_of_possible_matches,
+                       instrumentation=null_instrumentation,
+                       random_state=None):
+
+        with instrumentation.stage('segmentation'):
+            segmented_possible_matches = self.segment_image(
+                    image_of_possible_matches)
+
+        with instrumentation.stage('segment_labeling'):
+            segment_colors = self.label_segments(image_of_possible_matches,
+                                                 segmented_possible_matches,
+                                                 instrumentation,
+                                                 random_state)
+
+        # merge neighbouring segments of the same color into regions, which
+        # replace the segments from here on
+        if self.merge_regions:
+            with instrumentation.stage('region_merging'):
+                segmented_possible_matches, segment_colors, _ = merge_regions(
+                        segmented_possible_matches, segment_colors,
+                        self.merge_threshold, self.merge_same_color)
+            instrumentation.count('regions', len(segment_colors.segment_ids))
+
+        return segmented_possible_matches, segment_colors
+
+    def closet_parameters(self):
+
+        # everything that changes the result of analyze_closet
+        return {'model_digest': self.color_detector.model_digest,
+                'bits_per_channel': self.color_detector.bits_per_channel,
+                'image_width': self.image_width,
+                'reduced_decode': self.reduced_decode,
+                'percentile_correction': self.percentile_correction,
+                'edge_filter': self.edge_filter,
+                'n_segments': self.n_segments,
+                'compactness': self.compactness,
+                'sigma': self.sigma,
+                'segmentation': self.segmentation,
+                'segmentation_scale': self.segmentation_scale,
+                'segments_per_megapixel': self.segments_per_megapixel,
+                'segmentation_backend': self.segmentation_backend,
+                'refine_edges': self.refine_edges,
+                'merge_regions': self.merge_regions,
+                'merge_threshold': self.merge_threshold,
+                'merge_same_color': self.merge_same_color,
+                'sampling': self.sampling,
+                'confidence': self.confidence,
+                'min_samples': self.min_samples,
+                'max_samples': self.max_samples}
+
+    def analyze_closet(self, closet, instrumentation=null_instrumentation,
+                       seed=None):
+
+        # load, correct and segment the closet image, reusing a cached
+        # analysis of the same image content when there is one. With a seed
+        # and adaptive sampling, the pixels are sampled from a RandomState
+        # derived from the seed and the image content, as for the garment
+        closet = self.read_image(closet)
+
+        random_state = None
+        parameters = self.closet_parameters()
+        if seed is not None and self.sampling == 'adaptive':
+            random_state = np.random.RandomState(
+                    seeded_state(seed, image_digest(closet)))
+            parameters['seed'] = seed
+
+        key = None
+        if self.closet_cache is not None:
+            with instrumentation.stage('cache_lookup'):
+                key = cache_key(image_digest(closet), parameters)
+                analysis = self.closet_cache.get(key)
+            if analysis is not None:
+                instrumentation.count('closet_cache_hits')
+                return analysis
+            instrumentation.count('closet_cache_misses')
+
+        image_of_possible_matches = self.load_image(closet, instrumentation)
+        segmented_possible_matches, segment_colors = self.segment_closet(
+                image_of_possible_matches, instrumentation, random_state)
+        analysis = ClosetAnalysis(image_of_possible_matches,
+                                  segmented_possible_matches, segment_colors)
+
+        if key is not None:
+            analysis = self.closet_cache.put(key, analysis)
+
+        return analysis
+
+    def analyze_closet_tiled(self, closet, work_dir=None, tile_size=None,
+                             overlap=32, memory_budget=256 * 2 ** 20,
+                             threads=1, merge_fraction=0.5,
+                             instrumentation=null_instrumentation):
+
+        # analyze a very large closet image at full resolution, a tile at a
+        # time within memory_budget bytes (see tiled_processing.py). The
+        # corrected image and segment map are memory-mapped files in work_dir
+        segments_per_megapixel = self.segments_per_megapixel
+        if segments_per_megapixel is None:
+            segments_per_megapixel = default_segments_per_megapixel
+
+        return analyze_closet_tiled(
+                closet, self.color_detector, work_dir=work_dir,
+                tile_size=tile_size, overlap=overlap,
+                memory_budget=memory_budget, threads=threads,
+                percentile_correction=self.percentile_correction,
+                edge_filter=self.edge_filter,
+                segments_per_megapixel=segments_per_megapixel,
+                merge_fraction=merge_fraction,
+                instrumentation=instrumentation,
+                **self.segmentation_options())
+
+    ###########################################################
+    ### HIGHLIGHT THE MATCHING SEGMENTS IN THE CLOSET IMAGE ###
+    ###########################################################
+
+    def segments_to_highlight(self, segment_colors, matching_colors,
+                              instrumentation=null_instrumentation):
+
+        # find the segments whose color is one of the matching colors
+        unique_segments_colors = segment_color_names(
+                segment_colors, self.color_detector.class_names)
+        which_segments_to_highlight = np.array(
+                [(val in matching_colors) for val in unique_segments_colors],
+                dtype=bool)
+        unique_segments_to_highlight = segment_colors.segment_ids[
+                which_segments_to_highlight]
+        instrumentation.count('segments_highlighted',
+                              len(unique_segments_to_highlight))
+
+        return unique_segments_to_highlight
+
+    def highlight(self, image_of_possible_matches, segmented_possible_matches,
+                  segment_colors, matching_colors,
+                  instrumentation=null_instrumentation, **style):
+
+        unique_segments_to_highlight = self.segments_to_highlight(
+                segment_colors, matching_colors, instrumentation)
+
+        # grey-out the non-matching segments, leaving the matching segments
+        # as they are
+        style.setdefault('dim_factor', self.dim_factor)
+        image_of_highlighted_matches = highlight_segments(
+                image_of_possible_matches, segmented_possible_matches,
+                unique_segments_to_highlight, **style)
+
+        return Image.fromarray(image_of_highlighted_matches, 'RGB')
+
+    ###########################################################################
+    ### RETURN THE COLOR MATCHED TO, MATCHING COLORS, AND HIGHLIGHTED IMAGE ###
+    ###########################################################################
+
+    def analyze_pair(self, garment, seed, analyze_closet, instrumentation):
+
+        # the garment and closet analyses don't depend on each other, so
+        # within the thread budget the garment is analyzed on the helper
+        # thread while analyze_closet runs on this one, joining afterwards
+        if self.threads is None or self.threads < 2:
+            return (self.analyze_garment(garment, seed, instrumentation),
+                    analyze_closet())
+
+        if self.helper_pool is None:
+            self.helper_pool = ThreadPool(1)
+        pending = self.helper_pool.apply_async(
+                self.analyze_garment, (garment, seed, instrumentation))
+        closet_analysis = analyze_closet()
+
+        return pending.get(), closet_analysis
+
+    def analyze_match(self, garment, closet, method='complement', seed=None,
+                      instrumentation=null_instrumentation):
+
+        # determine the garment color, its matching colors and the color of
+        # every closet segment, without rendering anything
+        image_to_match_to_color, closet_analysis = self.analyze_pair(
+                garment, seed,
+                lambda: self.analyze_closet(closet, instrumentation, seed),
+                instrumentation)
+        matching_colors = self.matching_colors(image_to_match_to_color,
+                                               method)
+
+        result = MatchResult(image_to_match_to_color, matching_colors,
+                             closet_analysis.image,
+                             closet_analysis.segment_map,
+                             closet_analysis.segment_colors,
+                             self.color_detector.class_names,
+                             self.dim_factor)
+        instrumentation.count('segments_highlighted',
+                              len(result.matching_segments))
+
+        return result
+
+    def match_result(self, garment, closet, method='complement', seed=None,
+                     instrumentation=None, return_stats=False):
+
+        # the MatchResult holds the segment map and the color and match of
+        # every segment, and renders the highlighted image only when asked
+        if instrumentation is None:
+            if return_stats:
+                instrumentation = Instrumentation(
+                        trace_memory=self.trace_memory)
+            else:
+                instrumentation = null_instrumentation
+
+        result = self.analyze_match(garment, closet, method, seed,
+                                    instrumentation)
+
+        stats = instrumentation.finish()
+
+        if return_stats:
+            return result, stats
+
+        return result
+
+    def match(self, garment, closet, method='complement', seed=None,
+              instrumentation=None, return_stats=False, **style):
+
+        # measure each stage if asked to (by passing an Instrumentation, or
+        # asking for the stats), otherwise don't measure anything
+        if instrumentation is None:
+            if return_stats:
+                instrumentation = Instrumentation(
+                        trace_memory=self.trace_memory)
+            else:
+                instrumentation = null_instrumentation
+
+        result = self.analyze_match(garment, closet, method, seed,
+                                    instrumentation)
+
+        # grey-out the non-matching segments, leaving the matching segments
+        # as they are
+        with instrumentation.stage('compositing'):
+            image_of_highlighted_matches = result.to_image(**style)
+
+        stats = instrumentation.finish()
+
+        if return_stats:
+            return (result.garment_color, result.matching_colors,
+                    image_of_highlighted_matches, stats)
+
+        return (result.garment_color, result.matching_colors,
+                image_of_highlighted_matches)
+
+    def match_tiled(self, garment, closet, output_path, method='complement',
+                    seed=None, work_dir=None, tile_size=None, overlap=32,
+                    memory_budget=256 * 2 ** 20, threads=1,
+                    merge_fraction=0.5, instrumentation=None,
+                    return_stats=False, **style):
+
+        # like match, but the closet is processed in tiles at full
+        # resolution, and the highlighted image is written to output_path as
+        # a memory-mapped .npy file (returned instead of a PIL image)
+        if instrumentation is None:
+            if return_stats:
+                instrumentation = Instrumentation(
+                        trace_memory=self.trace_memory)
+            else:
+                instrumentation = null_instrumentation
+        if tile_size is None:
+            tile_size = tile_size_for_budget(memory_budget, threads, overlap)
+
+        image_to_match_to_color, closet_analysis = self.analyze_pair(
+                garment, seed,
+                lambda: self.analyze_closet_tiled(
+                        closet, work_dir, tile_size, overlap, memory_budget,
+                        threads, merge_fraction, instrumentation),
+                instrumentation)
+        matching_colors = self.matching_colors(image_to_match_to_color,
+                                               method)
+
+        with instrumentation.stage('compositing'):
+            style.setdefault('dim_factor', self.dim_factor)
+            image_of_highlighted_matches = highlight_tiled(
+                    closet_analysis, self.segments_to_highlight(
+                            closet_analysis.segment_colors, matching_colors,
+                            instrumentation),
+                    output_path, tile_size, threads, **style)
+
+        stats = instrumentation.finish()
+
+        if return_stats:
+            return (image_to_match_to_color, matching_colors,
+                    image_of_highlighted_matches, stats)
+
+        return (image_to_match_to_color, matching_colors,
+                image_of_highlighted_matches)
+
+    def match_frames(self, garment, frames, method='complement', seed=None,
+                     block_size=32, change_threshold=8.0,
+                     keyframe_fraction=0.5, motion_compensation=True,
+                     instrumentation=null_instrumentation, **style):
+
+        # match every frame of a video file (or an iterable of Red Green Blue
+        # arrays) against the garment, re-segmenting only the parts of each
+        # frame that changed (see frame_streaming.py). Yields FrameMatch
+        # tuples of highlighted frames
+        return match_frames(self, garment, frames, method, seed, block_size,
+                            change_threshold, keyframe_fraction,
+                            motion_compensation, instrumentation, **style)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A local matching server. An HTTP front end on localhost feeds a pool of
+pre-warmed worker processes, each holding a loaded CharmonyEngine, through a
+bounded request queue. Requests that don't fit in the queue are turned away
+straight away (503), and requests that take longer than the timeout are
+answered with a 504, so latency stays predictable under concurrent load.
+
+POST /match with a json body:
+    {"method": "complement" or "triad",
+     "garment": base64 encoded image bytes,
+     "closet": base64 encoded image bytes,
+     "format": "png" or "jpeg" (optional, default "png"),
+     "render": false to skip the highlighted image (optional),
+     "regions": true for the matching regions (optional)}
+returns a json body:
+    {"garment_color": ..., "matching_colors": [...], "area_fraction": ...,
+     "image": base64 encoded highlighted closet image, "format": ...,
+     "regions": [{"segment_id", "color", "bbox", "area_fraction", "rle"}]}
+
+GET /health returns the number of workers, and the requests in flight.
+"""
+import base64
+import json
+import threading
+from multiprocessing import Pool
+from multiprocessing import TimeoutError as PoolTimeoutError
+
+import numpy as np
+
+from charmony_engine import CharmonyEngine, match_rotation_dict
+from image_io import ImageDecodeError
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+# the engine of each worker process
+_worker_engine = None
+
+
+def _init_worker(engine_options):
+
+    global _worker_engine
+    _worker_engine = CharmonyEngine(**engine_options)
+
+
+def _serve_match(garment, closet, method, image_format, render, regions):
+
+    # run one match in a worker, returning errors (with their http status)
+    # rather than raising them, so the server always hears back from the
+    # worker. The highlighted image is only rendered if the client wants it
+    try:
+        result = _worker_engine.match_result(
+                np.frombuffer(garment, dtype=np.uint8),
+                np.frombuffer(closet, dtype=np.uint8),
+                method)
+        response = result.as_dict(regions=regions)
+        if render:
+            response['image'] = result.encode(image_format)
+            response['format'] = image_format
+        return response
+    except ImageDecodeError as error:
+        # images that can't be decoded are the client's mistake
+        return {'error': str(error), 'status': 400}
+    except Exception as error:
+        return {'error': '%s: %s' % (type(error).__name__, error),
+                'status': 500}
+
+
+class CharmonyServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=8765, workers=4, queue_size=16,
+                 timeout=30.0, **engine_options):
+
+        # start the worker processes, each loading its engine up front
+        self.workers = workers
+        self.pool = Pool(workers, initializer=_init_worker,
+                         initargs=(engine_options,))
+
+        HTTPServer.__init__(self, (host, port), CharmonyRequestHandler)
+
+        # the number of requests that can be running or waiting at once.
+        # Each slot is only freed when its worker finishes, so a timed out
+        # request still counts against the queue until its work is done.
+        # (HTTPServer's own 'timeout' is for handle_request, so it's left be)
+        self.request_timeout = timeout
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+        self.in_flight_lock = threading.Lock()
+        self.in_flight = 0
+
+    def release_slot(self, result=None):
+        with self.in_flight_lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def submit(self, garment, closet, method, image_format, render=True,
+               regions=False):
+
+        # turn the request away if the queue is full
+        if not self.slots.acquire(False):
+            return None
+
+        with self.in_flight_lock:
+            self.in_flight += 1
+
+        return self.pool.apply_async(_serve_match,
+                                     (garment, closet, method, image_format,
+                                      render, regions),
+                                     callback=self.release_slot)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class CharmonyRequestHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+
+        if self.path != '/health':
+            return self.send_json(404, {'error': 'not found'})
+
+        self.send_json(200, {'workers': self.server.workers,
+                             'queue_size': self.server.queue_size,
+                             'in_flight': self.server.in_flight})
+
+    def do_POST(self):
+
+        if self.path != '/match':
+            return self.send_json(404, {'error': 'not found'})
+
+        # read the request, and decode the images' bytes
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            garment = base64.b64decode(request['garment'])
+            closet = base64.b64decode(request['closet'])
+            method = request.get('method', 'complement')
+            image_format = request.get('format', 'png')
+            render = bool(request.get('render', True))
+            regions = bool(request.get('regions', False))
+        except (ValueError, KeyError, TypeError) as error:
+            return self.send_json(400, {'error': 'bad request: %s' % error})
+
+        if image_format not in ('png', 'jpeg', 'jpg'):
+            return self.send_json(400, {'error': 'unknown format: %s' %
+                                        image_format})
+        if method not in match_rotation_dict:
+            return self.send_json(400, {'error': 'unknown method: %s' %
+                                        method})
+
+        # queue the match, or tell the client to back off if the queue is full
+        pending = self.server.submit(garment, closet, method, image_format,
+                                     render, regions)
+        if pending is None:
+            return self.send_json(503, {'error': 'server busy'})
+
+        try:
+            result = pending.get(self.server.request_timeout)
+        except PoolTimeoutError:
+            return self.send_json(504, {'error': 'timed out'})
+
+        if 'error' in result:
+            return self.send_json(result.pop('status'), result)
+
+        if 'image' in result:
+            result['image'] = base64.b64encode(
+                    result['image']).decode('ascii')
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        # keep the request log quiet
+        pass
+
+
+def serve(host='127.0.0.1', port=8765, workers=4, queue_size=16,
+          timeout=30.0, **engine_options):
+
+    server = CharmonyServer(host, port, workers, queue_size, timeout,
+                            **engine_options)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a local cHarmony '
+                                                 'color matching server.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--timeout', type=float, default=30.0)
+    parser.add_argument('--model-path', default='color_detector.pkl')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='thread budget of each worker (see '
+                             'CharmonyEngine)')
+    parser.add_argument('--opencv-threads', type=int, default=None,
+                        help="size of each worker's OpenCV thread pool")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers, args.queue_size, args.timeout,
+          model_path=args.model_path, threads=args.threads,
+          opencv_threads=args.opencv_threads)
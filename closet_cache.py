@@ -0,0 +1,227 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+An in-memory and on-disk cache of analyzed closet images. Each entry holds the
+color corrected closet image, its segment label map and the per-segment color
+table, keyed by a hash of the image content and the preprocessing parameters.
+Both levels evict the least recently used entries to stay within a size
+budget, so a repeat closet query skips decoding, color correction,
+segmentation and segment labeling.
+"""
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from segment_colors import SegmentColors
+
+
+# image: the resized and color corrected closet image
+# segment_map: the segment label of every pixel
+# segment_colors: the per-segment color table (see segment_colors.py)
+ClosetAnalysis = namedtuple('ClosetAnalysis', ['image', 'segment_map',
+                                               'segment_colors'])
+
+
+def image_digest(image):
+
+    # hash the shape and contents of an image array (or of the encoded bytes
+    # of an image file)
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(repr((image.shape, image.dtype.str)).encode('utf-8'))
+    digest.update(image.data)
+
+    return digest.hexdigest()
+
+
+def cache_key(image_hash, parameters):
+
+    # combine the image hash with the preprocessing parameters, so changing
+    # any parameter gives a different entry
+    digest = hashlib.sha1(image_hash.encode('utf-8'))
+    digest.update(repr(sorted(parameters.items())).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def read_only(analysis):
+
+    # read-only views of the arrays of an analysis, so a cached analysis
+    # can't be changed by the callers it's handed to
+    def view(array):
+        array = np.asarray(array).view()
+        array.setflags(write=False)
+        return array
+
+    return ClosetAnalysis(view(analysis.image), view(analysis.segment_map),
+                          SegmentColors(*[view(field) for field in
+                                          analysis.segment_colors]))
+
+
+def analysis_nbytes(analysis):
+
+    return (analysis.image.nbytes + analysis.segment_map.nbytes +
+            sum(np.asarray(field).nbytes for field in analysis.segment_colors))
+
+
+class ClosetCache(object):
+
+    def __init__(self, cache_dir=None, memory_budget=256 * 2 ** 20,
+                 disk_budget=2 * 2 ** 30):
+        # keep up to memory_budget bytes of analyses in memory, and (if a
+        # cache_dir is given) up to disk_budget bytes of analyses on disk
+        self.cache_dir = cache_dir
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+
+        self.entries = OrderedDict()
+        self.memory_used = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir is not None and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    ###################################
+    ### LOOKING UP AND ADDING ITEMS ###
+    ###################################
+
+    def get(self, key):
+
+        # look in memory first, marking the entry as most recently used. The
+        # analyses handed out are read-only
+        if key in self.entries:
+            analysis = self.entries.pop(key)
+            self.entries[key] = analysis
+            self.hits += 1
+            return analysis
+
+        # then look on disk, and keep what we find in memory. Another process
+        # sharing the directory may evict the file while we read it, and a
+        # file that can't be read back (e.g. truncated) is removed
+        path = None
+        if self.cache_dir is not None:
+            path = self.entry_path(key)
+        if path is not None and os.path.exists(path):
+            try:
+                analysis = self.read_entry(path)
+                os.utime(path, None)
+            except (IOError, OSError):
+                analysis = None
+            except Exception:
+                analysis = None
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            if analysis is not None:
+                self.hits += 1
+                return self.remember(key, analysis)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, analysis):
+
+        # returns the read-only analysis that was cached
+        analysis = self.remember(key, analysis)
+
+        if self.cache_dir is not None:
+            self.write_entry(self.entry_path(key), analysis)
+            self.evict_disk()
+
+        return analysis
+
+    def remember(self, key, analysis):
+
+        if key in self.entries:
+            self.memory_used -= analysis_nbytes(self.entries.pop(key))
+
+        analysis = read_only(analysis)
+        self.entries[key] = analysis
+        self.memory_used += analysis_nbytes(analysis)
+
+        # drop the least recently used entries until we're within budget,
+        # always keeping the newest entry
+        while self.memory_used > self.memory_budget and len(self.entries) > 1:
+            _, oldest = self.entries.popitem(last=False)
+            self.memory_used -= analysis_nbytes(oldest)
+
+        return analysis
+
+    def clear(self):
+        self.entries.clear()
+        self.memory_used = 0
+
+    ################################
+    ### READING AND WRITING DISK ###
+    ################################
+
+    def write_entry(self, path, analysis):
+
+        # store the label map in the smallest integer type that fits
+        segment_map = analysis.segment_map
+        if segment_map.size and segment_map.max() < 2 ** 16:
+            segment_map = segment_map.astype(np.uint16)
+        else:
+            segment_map = segment_map.astype(np.uint32)
+
+        # write to a temporary file of our own first (other processes may
+        # be writing the same entry), so a half written entry is never read
+        # back, then move it into place in one step
+        handle, temp_path = tempfile.mkstemp(suffix='.tmp',
+                                             dir=os.path.dirname(path))
+        try:
+            with os.fdopen(handle, 'wb') as binhandle:
+                np.savez_compressed(
+                        binhandle,
+                        image=analysis.image,
+                        segment_map=segment_map,
+                        **analysis.segment_colors._asdict())
+            os.rename(temp_path, path)
+        except Exception:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def read_entry(self, path):
+
+        with np.load(path) as data:
+            segment_colors = SegmentColors(
+                    *[data[field] for field in SegmentColors._fields])
+            return ClosetAnalysis(data['image'],
+                                  data['segment_map'].astype(np.int64),
+                                  segment_colors)
+
+    def evict_disk(self):
+
+        # remove the least recently used files until the cache directory is
+        # within its budget. Files another process removes meanwhile are
+        # skipped
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        disk_used = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries)[:-1]:
+            if disk_used <= self.disk_budget:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            disk_used -= size
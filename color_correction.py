@@ -3,87 +3,190 @@
 """
 A color correction method that balances the color histograms of an image based
 on a user defined threshold ("percent_correct"), and then adjusts the gamma
-and applies a bilateral filter.
+and applies a bilateral filter. For uint8 images, the balance and gamma are
+found from a 256 bin histogram per channel and applied as a single 256 entry
+lookup table per channel, which gives the same output as the original floating
+point implementation (kept as 'fix_color_reference').
 """
-# Now create a function to fix the color profiles
-def fix_color(image, percentile_correction):
-    import numpy as np
-    from skimage.exposure import adjust_gamma
-    import cv2
-    import math
-
-    ##############################################################
-    ### Simple Color Balance function ported from:             ###
-    ### https://gist.github.com/DavidYKay/9dad6c4ab0d8d7dbf3dc ###
-    ##############################################################
-    
-    def apply_mask(matrix, mask, fill_value):
-        masked = np.ma.array(matrix, mask=mask, fill_value=fill_value)
-        return masked.filled()
+import math
 
-    def apply_threshold(matrix, low_value, high_value):
-        low_mask = matrix < low_value
-        matrix = apply_mask(matrix, low_mask, low_value)
+import cv2
+import numpy as np
+from skimage.exposure import adjust_gamma
 
-        high_mask = matrix > high_value
-        matrix = apply_mask(matrix, high_mask, high_value)
 
-        return matrix
+##############################################################
+### Simple Color Balance function ported from:             ###
+### https://gist.github.com/DavidYKay/9dad6c4ab0d8d7dbf3dc ###
+##############################################################
 
-    def simplest_cb(image, percentile_correction):
-        # make sure it's an RBG image
-        assert image.shape[2] == 3
-        
-        # make sure the percentile correction is between 0 and 100
-        assert percentile_correction > 0 and percentile_correction < 100
+def apply_mask(matrix, mask, fill_value):
+    masked = np.ma.array(matrix, mask=mask, fill_value=fill_value)
+    return masked.filled()
 
-        # split the percentile correction into two
-        half_percent = percentile_correction / 200.0
+def apply_threshold(matrix, low_value, high_value):
+    low_mask = matrix < low_value
+    matrix = apply_mask(matrix, low_mask, low_value)
 
-        # split the image into Red Green and Blue channels
-        channels = cv2.split(image)
+    high_mask = matrix > high_value
+    matrix = apply_mask(matrix, high_mask, high_value)
 
-        out_channels = []
-        for channel in channels:
-            assert len(channel.shape) == 2
-            # find the low and high precentile values (based on the 
-            # input percentile)
-            height, width = channel.shape
-            vec_size = width * height
-            flat = channel.reshape(vec_size)
+    return matrix
 
-            assert len(flat.shape) == 1
+def simplest_cb(image, percentile_correction):
+    # make sure it's an RBG image
+    assert image.shape[2] == 3
 
-            flat = np.sort(flat)
+    # make sure the percentile correction is between 0 and 100
+    assert percentile_correction > 0 and percentile_correction < 100
 
-            n_cols = flat.shape[0]
+    # split the percentile correction into two
+    half_percent = percentile_correction / 200.0
 
-            low_val  = flat[int(math.floor(n_cols * half_percent))]
-            high_val = flat[int(math.ceil( n_cols * (1.0 - half_percent)))]
+    # split the image into Red Green and Blue channels
+    channels = cv2.split(image)
 
-            # saturate below the low percentile and above the high percentile
-            thresholded = apply_threshold(channel, low_val, high_val)
-            # scale the channel
-            normalized = cv2.normalize(thresholded, thresholded.copy(), 0, 255, cv2.NORM_MINMAX)
-            out_channels.append(normalized)
+    out_channels = []
+    for channel in channels:
+        assert len(channel.shape) == 2
+        # find the low and high precentile values (based on the 
+        # input percentile)
+        height, width = channel.shape
+        vec_size = width * height
+        flat = channel.reshape(vec_size)
+
+        assert len(flat.shape) == 1
+
+        flat = np.sort(flat)
+
+        n_cols = flat.shape[0]
+
+        low_val  = flat[int(math.floor(n_cols * half_percent))]
+        high_val = flat[int(math.ceil( n_cols * (1.0 - half_percent)))]
+
+        # saturate below the low percentile and above the high percentile
+        thresholded = apply_threshold(channel, low_val, high_val)
+        # scale the channel
+        normalized = cv2.normalize(thresholded, thresholded.copy(), 0, 255, cv2.NORM_MINMAX)
+        out_channels.append(normalized)
+
+    return cv2.merge(out_channels)
+
+
+######################################################################
+### Histogram based color balance and gamma, as one lookup table   ###
+######################################################################
+
+def channel_histograms(image):
+
+    # the 256 bin histogram of each channel of a uint8 image (3 x 256). The
+    # histograms of the parts of an image add up to the whole image's
+    return np.stack([np.bincount(image[:, :, channel].ravel(), minlength=256)
+                     for channel in np.arange(3)])
+
+def histogram_percentiles(histogram, half_percent):
+    # find the same low and high percentile values as simplest_cb, from a
+    # 256 bin histogram of the channel instead of sorting it. The value at
+    # position k of the sorted channel is the first value whose cumulative
+    # count is greater than k
+    cumulative = np.cumsum(histogram)
+    n_cols = cumulative[-1]
+
+    low_index = int(math.floor(n_cols * half_percent))
+    high_index = min(int(math.ceil(n_cols * (1.0 - half_percent))),
+                     n_cols - 1)
+
+    low_val = int(np.searchsorted(cumulative, low_index, side='right'))
+    high_val = int(np.searchsorted(cumulative, high_index, side='right'))
+
+    return low_val, high_val
+
+def color_lut(image, percentile_correction, gamma=0.75):
+    # make sure it's a uint8 RBG image
+    assert image.shape[2] == 3 and image.dtype == np.uint8
+
+    return histogram_color_lut(channel_histograms(image),
+                               percentile_correction, gamma)
+
+def histogram_color_lut(histograms, percentile_correction, gamma=0.75):
+    # make sure the percentile correction is between 0 and 100
+    assert percentile_correction > 0 and percentile_correction < 100
+
+    half_percent = percentile_correction / 200.0
+
+    # for each channel, run every possible uint8 value through the threshold,
+    # the min-max scaling and the gamma adjustment, giving one 256 entry
+    # table per channel. The channel's thresholded min and max are the low
+    # and high values, just as they are for the 0-255 ramp, so the table
+    # gives the same results as balancing and adjusting the image itself
+    values = np.arange(256, dtype=np.uint8)
+
+    lut = np.empty((256, 1, 3), dtype=np.uint8)
+    for channel in np.arange(3):
+        low_val, high_val = histogram_percentiles(histograms[channel],
+                                                  half_percent)
+        thresholded = np.clip(values, low_val, high_val).reshape(256, 1)
+        normalized = cv2.normalize(thresholded, thresholded.copy(), 0, 255,
+                                   cv2.NORM_MINMAX)
+        lut[:, 0, channel] = adjust_gamma(normalized, gamma=gamma,
+                                          gain=1).ravel()
+
+    return lut
+
+def edge_preserving_filter(image, edge_filter):
+    # 'bilateral' is effective at noise removal while preserving edges,
+    # 'median' is a cheaper edge preserving filter, and None skips filtering
+    if edge_filter == 'bilateral':
+        return cv2.bilateralFilter(image, 5, 75, 75)
+    if edge_filter == 'median':
+        return cv2.medianBlur(image, 3)
+    if edge_filter is None:
+        return image
+    raise ValueError('unknown edge_filter: %s' % edge_filter)
+
+
+# Now create a function to fix the color profiles
+def fix_color(image, percentile_correction, method='lut',
+              edge_filter='bilateral'):
 
-        return cv2.merge(out_channels)
-    
     ########################################################################
     ### Balance the image color, adjust gamma, and then filter the image ###
     ########################################################################
     
+    if method == 'lut':
+        # balance the color and adjust the gamma with one lookup per pixel
+        new_img = cv2.LUT(image, color_lut(image, percentile_correction))
+    else:
+        new_img = fix_color_reference(image, percentile_correction)
+
+    # filter the image with an edge preserving filter
+    return edge_preserving_filter(new_img, edge_filter)
+
+
+# the original floating point implementation, kept as the reference
+def fix_color_reference(image, percentile_correction):
+
     # implement the simple color balance
     new_img = simplest_cb(image, percentile_correction)
 
     # adjust the gamma to help boost the color profile
     new_img = adjust_gamma(new_img, gamma=0.75, gain=1)
     
-    # use a bilateral filter, which is effective at noise removal 
-    # while preserving edges
-    new_img = cv2.bilateralFilter(new_img, 5, 75, 75)
-    
     return new_img
 
 
+def check_fix_color(image, percentile_correction, tolerance=1):
+
+    # compare the lookup table path with the reference implementation, and
+    # make sure no pixel differs by more than 'tolerance' levels (the two
+    # should agree exactly, the tolerance allows for rounding differences
+    # between scikit-image versions)
+    fast = fix_color(image, percentile_correction, method='lut')
+    reference = fix_color(image, percentile_correction, method='reference')
+
+    max_difference = int(np.abs(fast.astype(np.int16) -
+                                reference.astype(np.int16)).max())
+    assert max_difference <= tolerance, \
+        'fix_color differs from the reference by %d levels' % max_difference
 
+    return max_difference
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A precomputed Red Green Blue to color name lookup table. The K-Nearest
+Neighbor color classifier ('color_detector.pkl') is evaluated once over a
+quantized Red Green Blue cube, and the resulting table of color labels is
+saved next to the pickle so whole images can be classified by array indexing
+instead of per-pixel 'predict' calls. The table is rebuilt automatically
+whenever the pickled classifier changes.
+"""
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from pickler import Pickler
+
+
+class ColorLookupTable(object):
+
+    def __init__(self, table, class_names, bits_per_channel,
+                 model_digest=None, accuracy=None):
+        # table[r >> shift, g >> shift, b >> shift] holds the index of the
+        # color name (in class_names) predicted for that Red Green Blue cell
+        self.table = table
+        self.class_names = np.array([str(name) for name in class_names])
+        self.bits_per_channel = bits_per_channel
+        self.shift = 8 - bits_per_channel
+        self.model_digest = model_digest
+        self.accuracy = accuracy
+
+    # classify an array of Red Green Blue values (any shape ending in 3) and
+    # return the color index of each one
+    def classify_ids(self, pixels):
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        shift = self.shift
+        return self.table[pixels[..., 0] >> shift,
+                          pixels[..., 1] >> shift,
+                          pixels[..., 2] >> shift]
+
+    # classify a whole image (height x width x 3) into a map of color indices
+    def classify_image(self, image):
+        return self.classify_ids(image)
+
+    # a drop in replacement for the classifier's 'predict', returning color
+    # names for each row of Red Green Blue values
+    def predict(self, pixels):
+        pixels = np.asarray(pixels).reshape(-1, 3)
+        return self.class_names[self.classify_ids(pixels)]
+
+
+def build_color_lut(color_detector, bits_per_channel=6, batch_size=65536):
+
+    # make sure the table has a sensible resolution (a 24-bit table is
+    # 16.7 million cells, a 6-bit per channel table is 262,144 cells)
+    assert 1 <= bits_per_channel <= 8
+
+    levels = 2 ** bits_per_channel
+    step = 256 // levels
+
+    # classify the center of each quantized cell in the Red Green Blue cube
+    cell_centers = np.arange(levels) * step + step // 2
+    red, green, blue = np.meshgrid(cell_centers, cell_centers, cell_centers,
+                                   indexing='ij')
+    cube = np.stack([red.ravel(), green.ravel(), blue.ravel()], axis=1)
+
+    class_names = [str(name) for name in color_detector.classes_]
+    name_to_index = dict((name, index) for index, name in
+                         enumerate(class_names))
+
+    labels = np.empty(len(cube), dtype=np.uint8)
+    for start in np.arange(0, len(cube), batch_size):
+        predicted = color_detector.predict(cube[start:start + batch_size])
+        labels[start:start + batch_size] = [name_to_index[str(name)] for
+                                            name in predicted]
+
+    table = labels.reshape(levels, levels, levels)
+
+    return ColorLookupTable(table, class_names, bits_per_channel)
+
+
+def lut_accuracy(color_lut, color_detector, n_samples=20000, random_state=0):
+
+    # compare the table against the original classifier on random uint8
+    # Red Green Blue values, and return the fraction that agree
+    random_state = np.random.RandomState(random_state)
+    samples = random_state.randint(0, 256, (n_samples, 3))
+
+    knn_colors = np.array([str(name) for name in
+                           color_detector.predict(samples)])
+    lut_colors = color_lut.predict(samples)
+
+    return float(np.mean(knn_colors == lut_colors))
+
+
+def file_digest(path):
+
+    # hash the pickled classifier, so we know when the table is out of date
+    digest = hashlib.sha1()
+    with open(path, 'rb') as binhandle:
+        for chunk in iter(lambda: binhandle.read(1 << 20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def save_color_lut(color_lut, lut_path):
+
+    # save the table as a plain .npy file (so it can be memory mapped), and
+    # the color names and model digest in a json file beside it
+    temp_path = lut_path + '.tmp'
+    with open(temp_path, 'wb') as binhandle:
+        np.save(binhandle, np.ascontiguousarray(color_lut.table))
+    os.rename(temp_path, lut_path)
+
+    metadata = {'bits_per_channel': color_lut.bits_per_channel,
+                'class_names': [str(name) for name in color_lut.class_names],
+                'model_digest': color_lut.model_digest,
+                'accuracy': color_lut.accuracy}
+    with open(lut_path + '.json', 'w') as handle:
+        json.dump(metadata, handle)
+
+
+def load_color_lut(model_path='color_detector.pkl', lut_path=None,
+                   bits_per_channel=6, verbose=False):
+
+    # by default, keep the table beside the pickled classifier
+    if lut_path is None:
+        lut_path = os.path.splitext(model_path)[0] + '.lut.npy'
+
+    model_digest = file_digest(model_path)
+
+    # use the saved table if it was built from this exact classifier
+    metadata = None
+    if os.path.exists(lut_path) and os.path.exists(lut_path + '.json'):
+        with open(lut_path + '.json', 'r') as handle:
+            metadata = json.load(handle)
+
+    if (metadata is not None and
+            metadata.get('model_digest') == model_digest and
+            metadata.get('bits_per_channel') == bits_per_channel):
+        table = np.load(lut_path, mmap_mode='r')
+        return ColorLookupTable(table, metadata['class_names'],
+                                bits_per_channel, model_digest,
+                                metadata.get('accuracy'))
+
+    # otherwise unpickle the model, rebuild the table and save it
+    color_detector_pickled = open(model_path, 'rb')
+    color_detector = Pickler.load_pickle(color_detector_pickled)
+    color_detector_pickled.close()
+
+    color_lut = build_color_lut(color_detector, bits_per_channel)
+    color_lut.model_digest = model_digest
+    color_lut.accuracy = lut_accuracy(color_lut, color_detector)
+
+    if verbose:
+        print('Rebuilt color lookup table (%d bits per channel), '
+              'agreement with the classifier: %.2f%%' %
+              (bits_per_channel, 100.0 * color_lut.accuracy))
+
+    save_color_lut(color_lut, lut_path)
+
+    return color_lut
+
+
+if __name__ == '__main__':
+    import sys
+
+    # build (or refresh) the table for a pickled classifier and report how
+    # closely it agrees with the classifier
+    model_path = sys.argv[1] if len(sys.argv) > 1 else 'color_detector.pkl'
+    bits_per_channel = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+
+    color_lut = load_color_lut(model_path,
+                               bits_per_channel=bits_per_channel,
+                               verbose=True)
+    print('Color lookup table: %d bits per channel, %d colors, '
+          'agreement with the classifier: %.2f%%' %
+          (color_lut.bits_per_channel, len(color_lut.class_names),
+           100.0 * color_lut.accuracy))
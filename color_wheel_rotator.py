@@ -7,11 +7,11 @@ degree rotation.
 """
 # function altered from original code at:
 # https://stackoverflow.com/questions/14095849/calculating-the-analogous-color-with-python
+from colorsys import rgb_to_hls, hls_to_rgb
+
 
 def rotate_colors((red, green, blue), degreee_rotation):
 
-    from colorsys import rgb_to_hls, hls_to_rgb
-    
     # turn the degree rotation into a percent rotation
     degreee_rotation = degreee_rotation/360.0
     
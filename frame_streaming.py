@@ -0,0 +1,293 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Incremental color matching over a video or a sequence of closet frames (e.g.
+a camera sweep of a closet). The garment is analyzed once, and each frame is
+compared with the last one block by block: camera motion is compensated with
+a global shift, and only the blocks that changed are re-segmented and
+re-classified, while the segment labels of the rest of the frame carry over.
+A full re-segmentation (a keyframe) happens on the first frame, and whenever
+too much of the frame changed at once. Highlighted frames are yielded by a
+generator.
+"""
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from color_correction import color_lut, edge_preserving_filter
+from highlight import highlight_segments
+from image_io import string_types
+from instrumentation import null_instrumentation
+from resize_image import resize_image
+from segment_colors import label_segment_colors
+from segmentation import default_segments_per_megapixel, segment_image
+
+
+# index: the position of the frame in the sequence
+# garment_color: the color of the garment matched to
+# matching_colors: the colors that match the garment
+# image: the highlighted frame (a Red Green Blue uint8 array)
+# changed_fraction: the fraction of the frame that was re-segmented
+# keyframe: whether the whole frame was re-segmented
+FrameMatch = namedtuple('FrameMatch', ['index', 'garment_color',
+                                       'matching_colors', 'image',
+                                       'changed_fraction', 'keyframe'])
+
+
+def video_frames(path):
+
+    # the frames of a video file, as Red Green Blue arrays
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise IOError('could not open video: %s' % path)
+    try:
+        while True:
+            success, frame = capture.read()
+            if not success:
+                break
+            yield frame[:, :, ::-1]
+    finally:
+        capture.release()
+
+
+#########################
+### DETECTING CHANGES ###
+#########################
+
+def estimate_shift(previous_gray, gray, min_response=0.1):
+
+    # the whole-pixel (rows, columns) translation from the previous frame to
+    # this one, by phase correlation. Weak peaks (no clear global motion)
+    # count as no shift
+    (dx, dy), response = cv2.phaseCorrelate(previous_gray, gray)
+    if response < min_response:
+        return 0, 0
+
+    return int(round(dy)), int(round(dx))
+
+
+def shift_array(array, rows, columns, fill_value):
+
+    # translate an array by (rows, columns), filling the uncovered band
+    shifted = np.full_like(array, fill_value)
+    height, width = array.shape[:2]
+    if abs(rows) >= height or abs(columns) >= width:
+        return shifted
+
+    source = array[max(-rows, 0):height - max(rows, 0),
+                   max(-columns, 0):width - max(columns, 0)]
+    shifted[max(rows, 0):max(rows, 0) + source.shape[0],
+            max(columns, 0):max(columns, 0) + source.shape[1]] = source
+
+    return shifted
+
+
+def block_means(values, block_size):
+
+    # the mean of a 2-D array over each block_size square block (the blocks
+    # along the bottom and right edges may be smaller)
+    height, width = values.shape
+    return cv2.resize(values.astype(np.float32),
+                      dsize=(-(-width // block_size), -(-height // block_size)),
+                      interpolation=cv2.INTER_AREA)
+
+
+def changed_blocks(image, reference, block_size, threshold):
+
+    # flag the blocks whose mean absolute difference from the reference (in
+    # the channel that changed most) is above threshold
+    difference = cv2.absdiff(image, reference).max(axis=2)
+    return block_means(difference, block_size) > threshold
+
+
+###########################
+### TRACKING THE CLOSET ###
+###########################
+
+class FrameTracker(object):
+
+    def __init__(self, engine, block_size=32, change_threshold=8.0,
+                 keyframe_fraction=0.5, motion_compensation=True):
+
+        # engine: a CharmonyEngine, whose image width, color correction,
+        # segmentation and color lookup table options are used
+        self.engine = engine
+        self.block_size = block_size
+        self.change_threshold = change_threshold
+        self.keyframe_fraction = keyframe_fraction
+        self.motion_compensation = motion_compensation
+
+        # the frame each block was last segmented from, its gray version
+        # (for motion estimates), and the labels and colors of its pixels
+        self.reference = None
+        self.reference_gray = None
+        self.segment_map = None
+        self.color_map = None
+        self.color_correction_lut = None
+        self.next_label = 0
+
+    def segments_for(self, height, width):
+
+        # as many segments per pixel as the engine uses for a whole frame
+        frame_height, frame_width = self.reference.shape[:2]
+        density = default_segments_per_megapixel / 1e6
+        if self.engine.segments_per_megapixel is not None:
+            density = self.engine.segments_per_megapixel / 1e6
+        elif self.engine.n_segments is not None:
+            density = self.engine.n_segments / float(frame_height *
+                                                     frame_width)
+
+        return max(int(round(density * height * width)), 1)
+
+    def resegment(self, corrected, box):
+
+        # re-segment and re-classify the pixels in a (top, bottom, left,
+        # right) box, with labels that haven't been used before
+        top, bottom, left, right = box
+        region = corrected[top:bottom, left:right]
+        labels = segment_image(region, self.segments_for(bottom - top,
+                                                         right - left),
+                               **self.engine.segmentation_options())
+
+        segment_ids, labels = np.unique(labels, return_inverse=True)
+        self.segment_map[top:bottom, left:right] = labels.reshape(
+                region.shape[:2]) + self.next_label
+        self.next_label += len(segment_ids)
+        self.color_map[top:bottom, left:right] = \
+            self.engine.color_detector.classify_image(region)
+
+    def keyframe(self, frame, corrected):
+
+        height, width = frame.shape[:2]
+        self.segment_map = np.empty((height, width), dtype=np.int64)
+        self.color_map = np.empty((height, width), dtype=np.int64)
+        self.next_label = 0
+        self.reference = frame.copy()
+        self.resegment(corrected, (0, height, 0, width))
+
+    def update(self, frame, instrumentation=null_instrumentation):
+
+        # resize and color correct the frame. The color correction table is
+        # only rebuilt at keyframes, so colors stay stable between them
+        with instrumentation.stage('load'):
+            frame = np.ascontiguousarray(resize_image(
+                    np.asarray(frame, dtype=np.uint8),
+                    self.engine.image_width))
+            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY).astype(np.float32)
+
+        with instrumentation.stage('change_detection'):
+            is_keyframe = (self.reference is None or
+                           self.reference.shape != frame.shape)
+
+            if not is_keyframe:
+                # carry the labels, colors and reference along with the camera
+                if self.motion_compensation:
+                    rows, columns = estimate_shift(self.reference_gray, gray)
+                    if rows or columns:
+                        self.reference = shift_array(self.reference, rows,
+                                                     columns, 0)
+                        self.segment_map = shift_array(self.segment_map,
+                                                       rows, columns, -1)
+                        self.color_map = shift_array(self.color_map, rows,
+                                                     columns, -1)
+                        instrumentation.count('shifted_frames')
+
+                # blocks that changed, or that the camera uncovered
+                changed = changed_blocks(frame, self.reference,
+                                         self.block_size,
+                                         self.change_threshold)
+                changed |= block_means(self.segment_map < 0,
+                                       self.block_size) > 0
+                changed_fraction = float(changed.mean())
+                is_keyframe = changed_fraction > self.keyframe_fraction
+
+        with instrumentation.stage('color_correction'):
+            if is_keyframe:
+                self.color_correction_lut = color_lut(
+                        frame, self.engine.percentile_correction)
+            corrected = edge_preserving_filter(
+                    cv2.LUT(frame, self.color_correction_lut),
+                    self.engine.edge_filter)
+
+        with instrumentation.stage('segmentation'):
+            if is_keyframe:
+                self.keyframe(frame, corrected)
+                changed_fraction = 1.0
+                instrumentation.count('keyframes')
+            else:
+                self.update_regions(frame, corrected, changed)
+                self.compact_labels()
+            self.reference_gray = gray
+
+        with instrumentation.stage('segment_labeling'):
+            segment_colors = label_segment_colors(
+                    self.segment_map, self.color_map,
+                    len(self.engine.color_detector.class_names))
+
+        instrumentation.count('frames')
+        instrumentation.count('pixels_classified',
+                              int(changed_fraction * frame[:, :, 0].size))
+
+        return (corrected, self.segment_map, segment_colors, changed_fraction,
+                is_keyframe)
+
+    def compact_labels(self):
+
+        # renumber the labels still in use 0..n-1 (in the same order), so
+        # labels don't keep growing over a long sequence. Pixel colors are
+        # kept per pixel, so only the label map changes (and any -1 pixels
+        # the camera uncovered stay -1)
+        in_use = np.bincount(self.segment_map.ravel() + 1,
+                             minlength=self.next_label + 1) > 0
+        in_use[0] = False
+        new_labels = np.cumsum(in_use) - 1
+        new_labels[0] = -1
+        self.segment_map = new_labels[self.segment_map + 1]
+        self.next_label = int(in_use.sum())
+
+    def update_regions(self, frame, corrected, changed):
+
+        # re-segment the bounding box of each group of changed blocks (grown
+        # by a block, so the new segments have some context)
+        grown = cv2.dilate(changed.astype(np.uint8), np.ones((3, 3), np.uint8))
+        n_groups, _, stats, _ = cv2.connectedComponentsWithStats(grown,
+                                                                 connectivity=8)
+        height, width = frame.shape[:2]
+        for group in np.arange(1, n_groups):
+            left, top, n_columns, n_rows = stats[group, :4] * self.block_size
+            box = (top, min(top + n_rows, height),
+                   left, min(left + n_columns, width))
+            self.resegment(corrected, box)
+            self.reference[box[0]:box[1], box[2]:box[3]] = \
+                frame[box[0]:box[1], box[2]:box[3]]
+
+
+def match_frames(engine, garment, frames, method='complement', seed=None,
+                 block_size=32, change_threshold=8.0, keyframe_fraction=0.5,
+                 motion_compensation=True,
+                 instrumentation=null_instrumentation, **style):
+
+    # frames: a video file path, or an iterable of Red Green Blue arrays.
+    # The garment color and matching colors are worked out once
+    garment_color = engine.analyze_garment(garment, seed, instrumentation)
+    matching_colors = engine.matching_colors(garment_color, method)
+
+    if isinstance(frames, string_types):
+        frames = video_frames(frames)
+
+    style.setdefault('dim_factor', engine.dim_factor)
+    tracker = FrameTracker(engine, block_size, change_threshold,
+                           keyframe_fraction, motion_compensation)
+    for index, frame in enumerate(frames):
+        corrected, segment_map, segment_colors, changed_fraction, \
+            keyframe = tracker.update(frame, instrumentation)
+
+        with instrumentation.stage('compositing'):
+            highlighted = highlight_segments(
+                    corrected, segment_map, engine.segments_to_highlight(
+                            segment_colors, matching_colors, instrumentation),
+                    **style)
+
+        yield FrameMatch(index, garment_color, matching_colors, highlighted,
+                         changed_fraction, keyframe)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A function to highlight a set of segments in an image, and grey-out the rest.
+The highlight mask is built with a lookup over segment labels, and the
+grey-out (and optional tint and outline) is done with 256 entry lookup tables
+on uint8 arrays. With the default style the output matches the original
+'Image.blend(alpha = 0.85)' against a black mask pixel for pixel.
+"""
+import cv2
+import numpy as np
+
+
+def blend_lut(color, alpha):
+
+    # build a (3 x 256) table that blends every uint8 value of each channel
+    # towards 'color' by 'alpha'. The float32 arithmetic and truncation are
+    # the same as PIL's Image.blend, so the results are identical
+    values = np.arange(256, dtype=np.float32)
+    alpha = np.float32(alpha)
+
+    lut = np.empty((3, 256), dtype=np.uint8)
+    for channel in np.arange(3):
+        target = np.float32(color[channel])
+        blended = values + alpha * (target - values)
+        lut[channel] = np.clip(blended, 0, 255).astype(np.uint8)
+
+    return lut
+
+
+def apply_lut(image, lut):
+
+    # look up each channel of the image in its row of the table
+    return lut[np.arange(3), image]
+
+
+def highlight_mask(segment_map, segments_to_highlight):
+
+    # flag the highlighted segment labels in a lookup array, and index it with
+    # the label map to get a boolean mask of the highlighted pixels
+    segments_to_highlight = np.asarray(segments_to_highlight, dtype=np.int64)
+    n_labels = int(segment_map.max()) + 1
+    if segments_to_highlight.size:
+        n_labels = max(n_labels, int(segments_to_highlight.max()) + 1)
+
+    is_highlighted = np.zeros(n_labels, dtype=bool)
+    is_highlighted[segments_to_highlight] = True
+
+    return is_highlighted[segment_map]
+
+
+def highlight_segments(image, segment_map, segments_to_highlight,
+                       dim_factor=0.85, dim_color=(0, 0, 0),
+                       tint_color=None, tint_factor=0.3,
+                       outline_color=None, outline_width=2):
+
+    # make sure the image is a uint8 Red Green Blue image
+    image = np.asarray(image, dtype=np.uint8)
+    assert image.shape[2] == 3
+
+    mask = highlight_mask(segment_map, segments_to_highlight)
+
+    # grey-out the non-matching pixels by blending them towards dim_color
+    dimmed = apply_lut(image, blend_lut(dim_color, dim_factor))
+
+    # optionally tint the matching pixels towards tint_color
+    if tint_color is not None:
+        highlighted = apply_lut(image, blend_lut(tint_color, tint_factor))
+    else:
+        highlighted = image
+
+    output = np.where(mask[:, :, np.newaxis], highlighted, dimmed)
+
+    # optionally draw an outline along the inner edge of the matching regions
+    if outline_color is not None:
+        mask_uint8 = mask.astype(np.uint8)
+        eroded = cv2.erode(mask_uint8, np.ones((3, 3), dtype=np.uint8),
+                           iterations=outline_width)
+        output[(mask_uint8 > eroded)] = outline_color
+
+    return output
@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+An image loading function that decodes file paths, raw bytes, buffers and
+file-like objects straight into a Red Green Blue image of a given width. For
+large photos, the image is decoded at a reduced scale (for JPEGs, the
+downscaling happens in the DCT domain while decoding) chosen so it's still at
+least as large as the target, and the BGR to RGB swap is a view on the resized
+image rather than a full size copy.
+"""
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from cv2 import (IMREAD_COLOR, IMREAD_REDUCED_COLOR_2, IMREAD_REDUCED_COLOR_4,
+                 IMREAD_REDUCED_COLOR_8, error as cv2_error, imdecode)
+
+from resize_image import resize_image
+
+# file paths may be str or unicode
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# the reduced decode flags for each scale factor, largest first
+reduced_decode_flags = [(8, IMREAD_REDUCED_COLOR_8),
+                        (4, IMREAD_REDUCED_COLOR_4),
+                        (2, IMREAD_REDUCED_COLOR_2)]
+
+
+# the first bytes of JPEG, PNG, GIF, BMP, TIFF and WebP files
+image_magic_numbers = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a',
+                       b'GIF89a', b'BM', b'II*\x00', b'MM\x00*', b'RIFF')
+
+
+class ImageDecodeError(ValueError):
+
+    # raised for encoded image data that is empty or can't be decoded
+    pass
+
+
+def is_encoded_bytes(image):
+
+    # in Python 2 bytes are str, so tell encoded image bytes apart from a
+    # file path: paths never hold NUL bytes, and bytes starting with an
+    # image magic number are only a path if that file exists
+    if not isinstance(image, bytes):
+        return False
+    if b'\x00' in image:
+        return True
+
+    return image.startswith(image_magic_numbers) and not os.path.exists(image)
+
+
+def read_bytes(image):
+
+    # turn a file path, file-like object, bytes or buffer into a 1-D uint8
+    # array of the encoded image, without copying buffers
+    if isinstance(image, (bytearray, memoryview)) or is_encoded_bytes(image):
+        pass
+    elif isinstance(image, string_types):
+        with open(image, 'rb') as binhandle:
+            image = binhandle.read()
+    elif hasattr(image, 'read'):
+        image = image.read()
+
+    if isinstance(image, (bytes, bytearray)):
+        image = np.frombuffer(image, dtype=np.uint8)
+    elif isinstance(image, memoryview):
+        image = np.asarray(image).view(np.uint8).ravel()
+    elif (isinstance(image, np.ndarray) and image.ndim == 2 and
+          image.dtype == np.uint8 and 1 in image.shape):
+        # cv2.imencode gives an (N, 1) column of encoded bytes, which is
+        # never a Red Green Blue image
+        image = image.ravel()
+
+    return image
+
+
+def decode_flag(encoded_image, target_width):
+
+    # read the image size from its header (without decoding it), and pick the
+    # largest reduction that still leaves both sides at least target_width
+    # wide, since the photo may be rotated by its orientation tag
+    if target_width is None:
+        return IMREAD_COLOR
+
+    try:
+        width, height = Image.open(BytesIO(encoded_image.tobytes())).size
+    except IOError:
+        return IMREAD_COLOR
+
+    for factor, flag in reduced_decode_flags:
+        if min(width, height) // factor >= target_width:
+            return flag
+
+    return IMREAD_COLOR
+
+
+def load_image(image, target_width=None, reduced_decode=True):
+
+    # decode an encoded image (path, bytes, buffer or file-like object) in
+    # BGR, at a reduced scale when it's much larger than target_width
+    image = np.asarray(read_bytes(image))
+    is_encoded = image.ndim == 1
+    if is_encoded:
+        if not image.size:
+            raise ImageDecodeError('could not decode image: no image data')
+        flag = IMREAD_COLOR
+        if reduced_decode:
+            flag = decode_flag(image, target_width)
+        try:
+            image = imdecode(image, flag)
+        except cv2_error:
+            image = None
+        if image is None:
+            raise ImageDecodeError('could not decode image')
+    else:
+        image = image.astype(np.uint8, copy=False)
+
+    # Reduce the image size to the target width
+    if target_width is not None:
+        image = resize_image(image, new_basewidth=target_width)
+
+    # decoded images are BGR, so convert to RGB with a reversed view of the
+    # channels (in-memory arrays are already RGB)
+    if is_encoded:
+        image = image[:, :, ::-1]
+
+    return image
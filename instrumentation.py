@@ -0,0 +1,216 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Per-stage instrumentation for the color matching pipeline. An Instrumentation
+object records the wall time, CPU time and (optionally) peak memory of each
+stage, plus counters such as the number of pixels classified, collects
+them in a StageStats object, and passes them to any number of hooks (e.g. to
+feed a metrics system). When no instrumentation is asked for, the pipeline
+uses NullInstrumentation, whose stages and counters do nothing.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# the CPU time of this process (time.clock is CPU time on unix in Python 2)
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock
+
+# the most precise wall clock available
+wall_time = getattr(time, 'perf_counter', time.time)
+
+
+def peak_rss():
+
+    # the largest resident set size of this process so far, in bytes
+    # (ru_maxrss is in kilobytes, except on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+
+def reset_peak_rss():
+
+    # start peak_rss again from the current resident size, where the kernel
+    # allows it (Linux 4.0 and later). Returns whether it was reset. The peak
+    # is process-wide, so this is only meaningful with one stage at a time
+    try:
+        with open('/proc/self/clear_refs', 'w') as handle:
+            handle.write('5')
+    except (IOError, OSError):
+        return False
+
+    return True
+
+
+class StageStats(object):
+
+    def __init__(self):
+        # stage name: {'wall': seconds, 'cpu': seconds, 'peak_alloc': bytes}.
+        # cpu is the CPU time of the whole process, so when stages overlap
+        # on several threads (e.g. with CharmonyEngine(threads=2)), each one
+        # also counts the CPU time the others used meanwhile.
+        # peak_alloc is the peak traced by tracemalloc, or (where it isn't
+        # available, as in Python 2) how much the process's peak resident
+        # size grew, which misses memory reused below an earlier peak
+        self.stages = OrderedDict()
+        # counter name: value
+        self.counters = OrderedDict()
+
+    def total_wall(self):
+        # more than the elapsed time when stages ran on several threads
+        return sum(record['wall'] for record in self.stages.values())
+
+    def as_dict(self):
+        return {'stages': dict(self.stages), 'counters': dict(self.counters)}
+
+    def __repr__(self):
+        stages = ', '.join('%s=%.1fms' % (name, 1000 * record['wall'])
+                           for name, record in self.stages.items())
+        counters = ', '.join('%s=%s' % item for item in self.counters.items())
+        return 'StageStats(%s; %s)' % (stages, counters)
+
+
+class InstrumentationHook(object):
+
+    # subclass and override either method to receive the measurements
+
+    def stage_finished(self, name, record):
+        pass
+
+    def request_finished(self, stats):
+        pass
+
+
+class Stage(object):
+
+    # a context manager that measures one stage
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        if self.instrumentation.trace_memory == 'tracemalloc':
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            self.start_alloc = tracemalloc.get_traced_memory()[0]
+        elif self.instrumentation.trace_memory == 'rss':
+            self.start_alloc = peak_rss()
+        self.start_cpu = cpu_time()
+        self.start_wall = wall_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        record = {'wall': wall_time() - self.start_wall,
+                  'cpu': cpu_time() - self.start_cpu,
+                  'peak_alloc': None}
+        if self.instrumentation.trace_memory == 'tracemalloc':
+            peak = tracemalloc.get_traced_memory()[1]
+            record['peak_alloc'] = max(peak - self.start_alloc, 0)
+        elif self.instrumentation.trace_memory == 'rss':
+            record['peak_alloc'] = peak_rss() - self.start_alloc
+        self.instrumentation.finish_stage(self.name, record)
+        return False
+
+
+class Instrumentation(object):
+
+    def __init__(self, hooks=(), trace_memory=False):
+        # peak memory is only measured when trace_memory is set, with
+        # tracemalloc (which slows down allocation) when it's available, or
+        # else from the process's peak resident size
+        self.hooks = list(hooks)
+        self.trace_memory = None
+        if trace_memory and tracemalloc is not None:
+            self.trace_memory = 'tracemalloc'
+        elif trace_memory and resource is not None:
+            self.trace_memory = 'rss'
+        self.stats = StageStats()
+
+        # stages may finish on several threads at once (e.g. the garment and
+        # closet analyses of one match)
+        self.lock = threading.Lock()
+
+        if (self.trace_memory == 'tracemalloc' and
+                not tracemalloc.is_tracing()):
+            tracemalloc.start()
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def finish_stage(self, name, record):
+
+        # hooks see each measurement, while stages that run more than once
+        # (e.g. loading each image) add up in the stats
+        with self.lock:
+            for hook in self.hooks:
+                hook.stage_finished(name, record)
+
+            if name in self.stats.stages:
+                previous = self.stats.stages[name]
+                record = {'wall': previous['wall'] + record['wall'],
+                          'cpu': previous['cpu'] + record['cpu'],
+                          'peak_alloc': record['peak_alloc']}
+                if previous['peak_alloc'] is not None:
+                    record['peak_alloc'] = max(record['peak_alloc'],
+                                               previous['peak_alloc'])
+            self.stats.stages[name] = record
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats.counters[name] = (self.stats.counters.get(name, 0) +
+                                         value)
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.stats.counters[name] = value
+
+    def finish(self):
+        for hook in self.hooks:
+            hook.request_finished(self.stats)
+        return self.stats
+
+
+class NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullInstrumentation(object):
+
+    # does nothing, so the pipeline can always call stage() and count()
+    stats = None
+    null_stage = NullStage()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def count(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+    def finish(self):
+        return None
+
+
+null_instrumentation = NullInstrumentation()
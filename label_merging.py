@@ -0,0 +1,48 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A union-find forest over segment labels, used to merge segments into larger
+ones: the segments that cover the same pixels across tile seams (see
+tiled_processing.py), and neighbouring segments with similar colors (see
+region_merging.py).
+"""
+import numpy as np
+
+
+class LabelMerger(object):
+
+    # a union-find forest over segment labels, numbered from 0
+    def __init__(self):
+        self.parents = np.zeros(0, dtype=np.int64)
+
+    def add(self, n_labels):
+
+        # add n_labels new labels, each in a set of its own, and return the
+        # first of them
+        first = len(self.parents)
+        self.parents = np.concatenate([self.parents,
+                                       np.arange(first, first + n_labels)])
+        return first
+
+    def find(self, label):
+        root = label
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[label] != root:
+            self.parents[label], label = root, self.parents[label]
+        return root
+
+    def union(self, label, other):
+        root, other_root = self.find(label), self.find(other)
+        if root != other_root:
+            self.parents[max(root, other_root)] = min(root, other_root)
+
+    def roots(self):
+
+        # the root of every label, with all paths flattened
+        roots = self.parents.copy()
+        while True:
+            parent_roots = roots[roots]
+            if np.array_equal(parent_roots, roots):
+                return roots
+            roots = parent_roots
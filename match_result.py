@@ -0,0 +1,234 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A structured match result. It holds the closet's segment label map and the
+color and match of every segment. The matching regions are available as
+run-length encoded masks, bounding boxes and area fractions, without building
+any images. The highlighted image is only rendered when it's asked for, and
+it's encoded as a JPEG or PNG straight into a byte buffer.
+"""
+import numpy as np
+from PIL import Image
+from cv2 import COLOR_RGB2BGR, IMWRITE_JPEG_QUALITY, cvtColor, imencode
+from scipy.ndimage import find_objects
+
+from adaptive_sampling import margin_confidence
+from highlight import highlight_mask, highlight_segments
+from segment_colors import segment_color_names
+
+
+################################
+### RUN-LENGTH ENCODED MASKS ###
+################################
+
+def encode_rle(mask):
+
+    # the lengths of the alternating runs of False and True pixels of a mask,
+    # in row-major order, starting with a (possibly empty) run of False
+    flat = np.asarray(mask, dtype=bool).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat.size and flat[0]:
+        counts = np.concatenate([[0], counts])
+
+    return {'size': [int(side) for side in np.shape(mask)],
+            'counts': counts.tolist()}
+
+
+def decode_rle(rle):
+
+    # the boolean mask of a run-length encoding
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(rle['size'])
+
+
+def segment_boxes(segment_map, segment_ids):
+
+    # the (top, left, bottom, right) bounding box of each segment (None if
+    # it has no pixels), from one pass over the label map (find_objects
+    # skips label 0, hence the +1)
+    segment_ids = np.asarray(segment_ids)
+    if not len(segment_ids):
+        return []
+    boxes = find_objects(np.asarray(segment_map) + 1,
+                         int(segment_ids.max()) + 1)
+
+    return [None if boxes[segment_id] is None else
+            (boxes[segment_id][0].start, boxes[segment_id][1].start,
+             boxes[segment_id][0].stop, boxes[segment_id][1].stop)
+            for segment_id in segment_ids]
+
+
+def encode_image(image, image_format='png', quality=95):
+
+    # encode a PIL or Red Green Blue array image straight into a byte buffer
+    image = cvtColor(np.asarray(image), COLOR_RGB2BGR)
+    parameters = []
+    if image_format in ('jpeg', 'jpg'):
+        parameters = [IMWRITE_JPEG_QUALITY, quality]
+    succeeded, buffer = imencode('.' + image_format, image, parameters)
+    if not succeeded:
+        raise ValueError('could not encode image as %s' % image_format)
+
+    return buffer.tobytes()
+
+
+####################
+### MATCH RESULT ###
+####################
+
+class MatchResult(object):
+
+    def __init__(self, garment_color, matching_colors, image, segment_map,
+                 segment_colors, class_names, dim_factor=0.85):
+
+        self.garment_color = garment_color
+        self.matching_colors = list(matching_colors)
+
+        # the color corrected closet image, its segment label map, and the
+        # color votes of each segment
+        self.image = image
+        self.segment_map = segment_map
+        self.segment_colors = segment_colors
+
+        # the color name of every segment, and whether it matches
+        self.segment_color_names = segment_color_names(segment_colors,
+                                                       class_names)
+        self.matches = np.array([(name in self.matching_colors)
+                                 for name in self.segment_color_names],
+                                dtype=bool)
+        self.dim_factor = dim_factor
+
+        self._areas = None
+        self._confidences = None
+        self._rendered = {}
+
+    @property
+    def matching_segments(self):
+        return self.segment_colors.segment_ids[self.matches]
+
+    def segment_areas(self):
+
+        # the number of pixels of every segment in the label map (segment
+        # colors may only count a sample of the pixels)
+        if self._areas is None:
+            counts = np.bincount(np.asarray(self.segment_map).ravel())
+            segment_ids = self.segment_colors.segment_ids
+            self._areas = np.zeros(len(segment_ids), dtype=np.int64)
+            in_map = segment_ids < len(counts)
+            self._areas[in_map] = counts[segment_ids[in_map]]
+
+        return self._areas
+
+    def segment_confidences(self):
+
+        # the confidence (0.5-1, 0 if empty) that each segment's color is
+        # ahead of the runner-up, given the pixels counted. With adaptive
+        # sampling, segments below the engine's confidence ran out of samples
+        if self._confidences is None:
+            self._confidences = margin_confidence(
+                    self.segment_colors.histograms)
+
+        return self._confidences
+
+    def segment_table(self):
+
+        # the color, vote and match of every segment
+        areas = self.segment_areas()
+        confidences = self.segment_confidences()
+        return [{'segment_id': int(segment_id),
+                 'color': self.segment_color_names[index],
+                 'vote_fraction': float(
+                         self.segment_colors.vote_fractions[index]),
+                 'confidence': float(confidences[index]),
+                 'pixel_count': int(areas[index]),
+                 'matches': bool(self.matches[index])}
+                for index, segment_id in
+                enumerate(self.segment_colors.segment_ids)]
+
+    ########################
+    ### MATCHING REGIONS ###
+    ########################
+
+    def mask(self):
+
+        # the boolean mask of all the matching pixels
+        return highlight_mask(self.segment_map, self.matching_segments)
+
+    def mask_rle(self):
+        return encode_rle(self.mask())
+
+    def area_fraction(self):
+
+        # the fraction of the closet image covered by matching segments
+        return (float(self.segment_areas()[self.matches].sum()) /
+                np.asarray(self.segment_map).size)
+
+    def regions(self, rle=True):
+
+        # each matching segment's color, (top, left, bottom, right) bounding
+        # box, share of the image and (optionally) its mask within the box
+        matching_segments = self.matching_segments
+        if not len(matching_segments):
+            return []
+
+        segment_map = np.asarray(self.segment_map)
+        boxes = segment_boxes(segment_map, matching_segments)
+        areas = self.segment_areas()[self.matches]
+        names = self.segment_color_names[self.matches]
+        confidences = self.segment_confidences()[self.matches]
+
+        regions = []
+        for segment_id, box, area, name, confidence in zip(
+                matching_segments, boxes, areas, names, confidences):
+            if box is None:
+                continue
+            region = {'segment_id': int(segment_id),
+                      'color': name,
+                      'bbox': list(box),
+                      'area_fraction': float(area) / segment_map.size,
+                      'confidence': float(confidence)}
+            if rle:
+                top, left, bottom, right = box
+                region['rle'] = encode_rle(
+                        segment_map[top:bottom, left:right] == segment_id)
+            regions.append(region)
+
+        return regions
+
+    ########################################
+    ### RENDERING AND ENCODING ON DEMAND ###
+    ########################################
+
+    def render(self, **style):
+
+        # the highlighted image as a Red Green Blue uint8 array, rendered the
+        # first time it's asked for (with each style)
+        style.setdefault('dim_factor', self.dim_factor)
+        key = repr(sorted(style.items()))
+        if key not in self._rendered:
+            self._rendered[key] = highlight_segments(
+                    self.image, self.segment_map, self.matching_segments,
+                    **style)
+
+        return self._rendered[key]
+
+    def to_image(self, **style):
+        return Image.fromarray(self.render(**style), 'RGB')
+
+    def encode(self, image_format='png', quality=95, **style):
+        return encode_image(self.render(**style), image_format, quality)
+
+    def as_dict(self, regions=True, rle=True):
+
+        # a json serializable summary, without any pixels
+        summary = {'garment_color': self.garment_color,
+                   'matching_colors': self.matching_colors,
+                   'image_size': [int(side) for side in
+                                  np.shape(self.segment_map)],
+                   'area_fraction': self.area_fraction()}
+        if regions:
+            summary['regions'] = self.regions(rle)
+
+        return summary
@@ -3,12 +3,11 @@
 """
 A function to get the most frequent (mode) value from a list
 """
+import numpy as np
 
 
 def get_mode(list_of_values):
     
-    import numpy as np
-    
     # find all unique values and recreate the list with the indices of those
     # unique values
     unique_values, list_of_indices = np.unique(list_of_values,
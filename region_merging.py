@@ -0,0 +1,98 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Merging of neighbouring superpixels with similar colors into garment-level
+regions. A region adjacency graph is built over the segment label map, and
+neighbouring segments are merged, most similar first, while the color
+histograms of the two (growing) regions stay similar enough (and, by default,
+have the same most frequent color). The color votes of the merged segments
+are pooled, so each region is labeled from all of its pixels, and far fewer
+regions are left to highlight, index and composite.
+"""
+import numpy as np
+
+from label_merging import LabelMerger
+from segment_colors import summarize_histograms
+
+
+def adjacency_pairs(segment_index):
+
+    # the (a, b) pairs, a < b, of segment indices that touch horizontally or
+    # vertically somewhere in the map, with the length of their boundary
+    segment_index = np.asarray(segment_index, dtype=np.int64)
+    n_segments = int(segment_index.max()) + 1
+    left, right = segment_index[:, :-1].ravel(), segment_index[:, 1:].ravel()
+    top, bottom = segment_index[:-1, :].ravel(), segment_index[1:, :].ravel()
+    first = np.concatenate([left, top])
+    second = np.concatenate([right, bottom])
+
+    differs = first != second
+    low = np.minimum(first[differs], second[differs])
+    high = np.maximum(first[differs], second[differs])
+    codes, boundary_lengths = np.unique(low * n_segments + high,
+                                        return_counts=True)
+
+    return (np.stack([codes // n_segments, codes % n_segments], axis=1),
+            boundary_lengths)
+
+
+def histogram_similarity(histogram, other):
+
+    # the intersection of two normalized color histograms, from 0 (no color
+    # in common) to 1 (the same color distribution)
+    total, other_total = histogram.sum(), other.sum()
+    if not total or not other_total:
+        return 0.0
+
+    return float(np.minimum(histogram / float(total),
+                            other / float(other_total)).sum())
+
+
+def merge_regions(segment_map, segment_colors, similarity_threshold=0.7,
+                  same_color=True, min_boundary=1):
+
+    # returns the region label map, the SegmentColors of the regions (with
+    # the pooled histograms of their segments), and the region index of
+    # every segment in segment_colors
+    segment_ids = segment_colors.segment_ids
+    segment_index = np.searchsorted(segment_ids, segment_map)
+    histograms = segment_colors.histograms.astype(np.int64)
+    n_segments = len(segment_ids)
+
+    def similarity(histogram, other):
+        if same_color and histogram.argmax() != other.argmax():
+            return 0.0
+        return histogram_similarity(histogram, other)
+
+    # try the neighbours that are most alike first, so regions grow from
+    # their most uniform parts
+    merger = LabelMerger()
+    merger.add(n_segments)
+    pooled = histograms.copy()
+
+    if n_segments > 1:
+        pairs, boundary_lengths = adjacency_pairs(segment_index)
+        pairs = pairs[boundary_lengths >= min_boundary]
+        similarities = np.array([similarity(histograms[a], histograms[b])
+                                 for a, b in pairs])
+        order = np.argsort(-similarities, kind='mergesort')
+
+        for a, b in pairs[order[similarities[order] >=
+                                similarity_threshold]]:
+            # compare the regions the two segments belong to by now, so a
+            # chain of slightly different segments doesn't drift
+            root, other_root = merger.find(a), merger.find(b)
+            if root == other_root or similarity(
+                    pooled[root], pooled[other_root]) < similarity_threshold:
+                continue
+            merger.union(root, other_root)
+            pooled[merger.find(root)] = pooled[root] + pooled[other_root]
+
+    # number the regions 0..n-1, and relabel the map
+    roots = merger.roots()
+    region_roots, region_of_segment = np.unique(roots, return_inverse=True)
+    region_map = region_of_segment[segment_index]
+    region_colors = summarize_histograms(np.arange(len(region_roots)),
+                                         pooled[region_roots])
+
+    return region_map, region_colors, region_of_segment
@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A function to label every segment of a segmented image with its most frequent
+color in a single pass. Pixels are classified once (as a map of color
+indices), and a joint count over (segment, color) gives the color histogram of
+every segment at the same time.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+
+# segment_ids: the segment labels, in ascending order
+# color_ids: the most frequent color index of each segment (-1 if empty)
+# vote_fractions: the fraction of each segment's pixels with that color
+# pixel_counts: the number of pixels counted in each segment
+# histograms: the (segment x color) pixel counts
+SegmentColors = namedtuple('SegmentColors', ['segment_ids', 'color_ids',
+                                             'vote_fractions', 'pixel_counts',
+                                             'histograms'])
+
+
+def label_segment_colors(segment_map, color_map, n_colors, segment_ids=None,
+                         pixel_mask=None):
+
+    segment_map = np.asarray(segment_map).ravel()
+    color_map = np.asarray(color_map).ravel()
+
+    # optionally only count a subset of the pixels (e.g. a random sample)
+    if pixel_mask is not None:
+        pixel_mask = np.asarray(pixel_mask, dtype=bool).ravel()
+        segment_map = segment_map[pixel_mask]
+        color_map = color_map[pixel_mask]
+
+    # turn the segment labels into consecutive indices. If the caller asks
+    # for specific segment_ids (sorted and deduplicated here), segments with
+    # no pixels are kept (as empty)
+    if segment_ids is None:
+        segment_ids, segment_index = np.unique(segment_map,
+                                               return_inverse=True)
+    else:
+        segment_ids = np.unique(np.asarray(segment_ids,
+                                           dtype=segment_map.dtype))
+        if not len(segment_ids):
+            return summarize_histograms(
+                    segment_ids, np.zeros((0, n_colors), dtype=np.int64))
+        segment_index = np.searchsorted(segment_ids, segment_map)
+        segment_index = np.minimum(segment_index, len(segment_ids) - 1)
+
+        # ignore pixels whose segment wasn't asked for
+        is_requested = segment_ids[segment_index] == segment_map
+        segment_index = segment_index[is_requested]
+        color_map = color_map[is_requested]
+    n_segments = len(segment_ids)
+
+    # count every (segment, color) pair at once
+    joint_index = segment_index.astype(np.int64) * n_colors + color_map
+    histograms = np.bincount(joint_index,
+                             minlength=n_segments * n_colors).reshape(
+                                     n_segments, n_colors)
+
+    return summarize_histograms(segment_ids, histograms)
+
+
+def summarize_histograms(segment_ids, histograms):
+
+    # the mode color of each segment is its most frequent color, and the vote
+    # fraction is how many of the segment's pixels agreed with it
+    n_segments = len(segment_ids)
+    pixel_counts = histograms.sum(axis=1)
+    color_ids = histograms.argmax(axis=1)
+    mode_counts = histograms[np.arange(n_segments), color_ids]
+
+    vote_fractions = np.zeros(n_segments)
+    has_pixels = pixel_counts > 0
+    vote_fractions[has_pixels] = (mode_counts[has_pixels] /
+                                  pixel_counts[has_pixels].astype(float))
+
+    # segments without any pixels have no color
+    color_ids[~has_pixels] = -1
+
+    return SegmentColors(segment_ids, color_ids, vote_fractions, pixel_counts,
+                         histograms)
+
+
+def segment_color_names(segment_colors, class_names):
+
+    # convert each segment's color index into its color name (None if empty)
+    class_names = np.asarray(class_names, dtype=object)
+    names = np.empty(len(segment_colors.color_ids), dtype=object)
+    has_color = segment_colors.color_ids >= 0
+    names[has_color] = class_names[segment_colors.color_ids[has_color]]
+
+    return names
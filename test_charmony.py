@@ -0,0 +1,625 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Checks that the fast paths of the pipeline agree with the implementations
+they replaced, using benchmark.py's stand-in nearest color classifier and
+synthetic images, so they run without 'color_detector.pkl'.
+
+    python -m pytest -q test_charmony.py
+"""
+import base64
+import json
+import tempfile
+import threading
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+try:
+    from urllib2 import HTTPError, Request, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+
+from batch_matching import batch_match
+from benchmark import NearestColorClassifier, encode, stand_in_colors, \
+    synthetic_closet, synthetic_garment
+from charmony_engine import CharmonyEngine
+from charmony_pipeline import get_engine
+from charmony_server import CharmonyServer
+from closet_cache import ClosetCache
+from color_correction import check_fix_color
+from color_lookup import build_color_lut, lut_accuracy
+from frame_streaming import FrameTracker, match_frames
+from highlight import highlight_segments
+from instrumentation import Instrumentation, InstrumentationHook
+from match_result import decode_rle, encode_rle
+from pickler import Pickler
+from region_merging import merge_regions
+from segment_colors import label_segment_colors, segment_color_names, \
+    summarize_histograms
+from segmentation import segment_image, segmentation_quality_report
+from wardrobe_index import WardrobeIndex
+
+
+@pytest.fixture(scope='module')
+def color_lut():
+    return build_color_lut(NearestColorClassifier())
+
+
+@pytest.fixture(scope='module')
+def images():
+    random_state = np.random.RandomState(0)
+    return (synthetic_garment(300, 400, random_state),
+            synthetic_closet(900, 600, random_state))
+
+
+def match_images(engine, garment, closet, seed=0):
+    garment_color, matching_colors, image = engine.match(garment, closet,
+                                                         seed=seed)
+    return garment_color, matching_colors, np.asarray(image)
+
+
+##########################
+### COLOR LOOKUP TABLE ###
+##########################
+
+def test_lut_agrees_with_classifier(color_lut):
+
+    # exactly at the cell centers the table was built from, and almost
+    # everywhere else (the cells straddling a color boundary can differ)
+    classifier = NearestColorClassifier()
+    step = 256 // 2 ** color_lut.bits_per_channel
+    centers = np.arange(0, 256, step) + step // 2
+    cube = np.stack(np.meshgrid(centers, centers, centers, indexing='ij'),
+                    axis=-1).reshape(-1, 3)
+    assert np.array_equal(color_lut.predict(cube), classifier.predict(cube))
+    assert lut_accuracy(color_lut, classifier) > 0.95
+
+
+####################
+### HIGHLIGHTING ###
+####################
+
+def test_highlight_matches_image_blend():
+
+    # every uint8 value in every channel, dimmed as the original did
+    values = np.arange(256, dtype=np.uint8)
+    image = np.stack([values, values[::-1], np.roll(values, 100)],
+                     axis=-1)[np.newaxis]
+    segment_map = np.zeros(image.shape[:2], dtype=np.int64)
+
+    expected = Image.blend(Image.fromarray(image, 'RGB'),
+                           Image.new('RGB', (256, 1), (0, 0, 0)), 0.85)
+    highlighted = highlight_segments(image, segment_map, [], dim_factor=0.85)
+    assert np.array_equal(highlighted, np.asarray(expected))
+
+    # and the highlighted segments are left as they are
+    assert np.array_equal(highlight_segments(image, segment_map, [0]), image)
+
+
+########################
+### COLOR CORRECTION ###
+########################
+
+def test_fix_color_is_bit_identical(images):
+    for image in images:
+        assert check_fix_color(image, 10, tolerance=0) == 0
+
+
+#####################################
+### MATCHING IN BATCHES AND ALONE ###
+#####################################
+
+def test_batch_match_equals_match(color_lut, images):
+    garment, closet = images
+    engine = CharmonyEngine(color_lut=color_lut)
+
+    batch = list(batch_match([garment], [closet], methods=['complement'],
+                             processes=1, seed=3, color_lut=color_lut))
+    assert len(batch) == 1
+
+    garment_color, matching_colors, image = match_images(engine, garment,
+                                                         closet, seed=3)
+    assert batch[0].garment_color == garment_color
+    assert batch[0].matching_colors == matching_colors
+    assert np.array_equal(np.asarray(batch[0].image), image)
+
+
+######################
+### SEGMENT COLORS ###
+######################
+
+def test_requested_segment_ids():
+
+    # requested segments come back sorted, with empty ones kept, and asking
+    # for none gives an empty table
+    segment_map = np.array([[0, 0, 5], [5, 9, 9]])
+    color_map = np.array([[1, 1, 2], [2, 0, 0]])
+
+    segment_colors = label_segment_colors(segment_map, color_map, 3,
+                                          segment_ids=[9, 0, 7, 5])
+    assert segment_colors.segment_ids.tolist() == [0, 5, 7, 9]
+    assert segment_colors.color_ids.tolist() == [1, 2, -1, 0]
+
+    empty = label_segment_colors(segment_map, color_map, 3, segment_ids=[])
+    assert len(empty.segment_ids) == 0
+    assert empty.histograms.shape == (0, 3)
+
+
+########################
+### MATCHING REGIONS ###
+########################
+
+@pytest.mark.parametrize('mask', [
+        np.zeros((4, 5), dtype=bool),
+        np.ones((4, 5), dtype=bool),
+        np.eye(5, dtype=bool),
+        np.random.RandomState(0).rand(37, 23) > 0.5])
+def test_rle_roundtrip(mask):
+    rle = encode_rle(mask)
+    assert sum(rle['counts']) == mask.size
+    assert np.array_equal(decode_rle(rle), mask)
+
+
+####################
+### IMAGE INPUTS ###
+####################
+
+def test_bytes_and_path_inputs(color_lut, images, tmpdir):
+
+    # the same closet as a file path, raw bytes, a bytearray, a file object
+    # and an imencode buffer gives the same match
+    garment, closet = images
+    engine = CharmonyEngine(color_lut=color_lut)
+
+    buffer = encode(closet)
+    data = buffer.tobytes()
+    path = tmpdir.join('closet.jpg')
+    path.write_binary(data)
+
+    expected = match_images(engine, garment, str(path))
+    for closet_input in (data, bytearray(data), BytesIO(data), buffer):
+        garment_color, matching_colors, image = match_images(
+                engine, garment, closet_input)
+        assert (garment_color, matching_colors) == expected[:2]
+        assert np.array_equal(image, expected[2])
+
+
+####################
+### CLOSET CACHE ###
+####################
+
+def test_closet_cache_hit_equals_miss(color_lut, images, tmpdir):
+
+    # a cached closet (in memory, then on disk) gives the same match as
+    # analyzing it afresh, and its arrays can't be changed
+    garment, closet = images
+    cache = ClosetCache(str(tmpdir))
+    engine = CharmonyEngine(color_lut=color_lut, closet_cache=cache)
+
+    miss = match_images(engine, garment, closet)
+    memory_hit = match_images(engine, garment, closet)
+    cache.clear()
+    disk_hit = match_images(engine, garment, closet)
+    assert (cache.hits, cache.misses) == (2, 1)
+    for hit in (memory_hit, disk_hit):
+        assert hit[:2] == miss[:2]
+        assert np.array_equal(hit[2], miss[2])
+
+    analysis = engine.analyze_closet(closet)
+    with pytest.raises(ValueError):
+        analysis.segment_map[0, 0] = -1
+    assert [name for name in tmpdir.listdir() if
+            not name.basename.endswith('.npz')] == []
+
+
+def test_closet_cache_skips_bad_files(color_lut, images, tmpdir):
+
+    # a truncated or empty entry on disk is a miss, and is removed
+    cache = ClosetCache(str(tmpdir))
+    engine = CharmonyEngine(color_lut=color_lut, closet_cache=cache)
+    engine.analyze_closet(images[1])
+    entry, = tmpdir.listdir()
+
+    for data in (entry.read_binary()[:100], b''):
+        entry.write_binary(data)
+        cache.clear()
+        assert cache.get(entry.purebasename) is None
+        assert not entry.check()
+
+
+##############
+### ENGINE ###
+##############
+
+def test_engine_reloads_changed_model(tmpdir):
+
+    # the engine is kept while the pickled model stays the same, and
+    # rebuilt (with a new lookup table) once it changes
+    model_path = tmpdir.join('model.pkl')
+
+    def save_model(colors):
+        with model_path.open('wb') as binhandle:
+            Pickler.save_pickle(NearestColorClassifier(colors), binhandle)
+
+    save_model(stand_in_colors)
+    engine = get_engine(str(model_path))
+    assert get_engine(str(model_path)) is engine
+
+    save_model(dict((name, stand_in_colors[name])
+                    for name in ('red', 'green', 'blue', 'white')))
+    reloaded = get_engine(str(model_path))
+    assert reloaded is not engine
+    assert sorted(reloaded.color_detector.class_names) == \
+        ['blue', 'green', 'red', 'white']
+
+
+#######################
+### MATCHING SERVER ###
+#######################
+
+@pytest.fixture(scope='module')
+def server(color_lut):
+    server = CharmonyServer(port=0, workers=1, queue_size=1,
+                            color_lut=color_lut)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post_match(server, **body):
+
+    # the status and json body of a POST /match
+    url = 'http://127.0.0.1:%d/match' % server.server_address[1]
+    request = Request(url, json.dumps(body).encode('utf-8'),
+                      {'Content-Type': 'application/json'})
+    try:
+        response = urlopen(request)
+    except HTTPError as error:
+        response = error
+    return response.getcode(), json.loads(response.read().decode('utf-8'))
+
+
+def test_server_status_codes(server, images):
+    garment, closet = [base64.b64encode(encode(image).tobytes()).decode(
+            'ascii') for image in images]
+
+    status, body = post_match(server, garment=garment, closet=closet,
+                              render=False)
+    assert status == 200 and body['matching_colors']
+
+    # client mistakes are 400s
+    assert post_match(server, garment=garment, closet=closet,
+                      method='tetrad')[0] == 400
+    for bad_image in ('', base64.b64encode(b'not an image').decode('ascii')):
+        status, body = post_match(server, garment=garment, closet=bad_image)
+        assert status == 400 and 'could not decode' in body['error']
+
+    # a full queue turns requests away, and a slow match times out
+    n_slots = server.workers + server.queue_size
+    for _ in range(n_slots):
+        server.slots.acquire()
+    try:
+        assert post_match(server, garment=garment, closet=closet)[0] == 503
+    finally:
+        for _ in range(n_slots):
+            server.slots.release()
+
+    request_timeout = server.request_timeout
+    server.request_timeout = 1e-6
+    try:
+        assert post_match(server, garment=garment, closet=closet)[0] == 504
+    finally:
+        server.request_timeout = request_timeout
+
+
+#########################
+### ADAPTIVE SAMPLING ###
+#########################
+
+def test_adaptive_closet_sampling(color_lut, images):
+
+    # each segment gets at most max_samples votes, and a seed makes the
+    # votes reproducible
+    garment, closet = images
+    engine = CharmonyEngine(color_lut=color_lut, sampling='adaptive',
+                            min_samples=20, max_samples=50)
+
+    result = engine.match_result(garment, closet, seed=5)
+    assert result.segment_colors.pixel_counts.max() <= 50
+    assert np.all(result.segment_confidences() <= 1.0)
+
+    again = engine.match_result(garment, closet, seed=5)
+    assert np.array_equal(again.segment_colors.histograms,
+                          result.segment_colors.histograms)
+
+
+####################
+### SEGMENTATION ###
+####################
+
+def test_coarse_segmentation(color_lut, images):
+
+    # the coarse mode's segment count scales with the image area, and its
+    # segments color the closet about as the full resolution ones do
+    closet = images[1]
+    full = segment_image(closet)
+    coarse = segment_image(closet, mode='coarse')
+    quarter = segment_image(closet[:300, :450], mode='coarse')
+
+    n_segments = len(np.unique(coarse))
+    assert 0.15 < len(np.unique(quarter)) / float(n_segments) < 0.35
+    report = segmentation_quality_report(closet, full, coarse, color_lut)
+    assert report['color_agreement'] > 0.9
+
+
+#######################
+### INSTRUMENTATION ###
+#######################
+
+class RecordingHook(InstrumentationHook):
+
+    def __init__(self):
+        self.stages = []
+        self.requests = []
+
+    def stage_finished(self, name, record):
+        self.stages.append(name)
+
+    def request_finished(self, stats):
+        self.requests.append(stats)
+
+
+def test_instrumented_match(color_lut, images):
+
+    # measuring a match leaves its result unchanged, and every stage is
+    # reported to the hooks and in the stats, with its peak memory
+    garment, closet = images
+    engine = CharmonyEngine(color_lut=color_lut)
+    hook = RecordingHook()
+    instrumentation = Instrumentation([hook], trace_memory=True)
+
+    garment_color, matching_colors, image, stats = engine.match(
+            garment, closet, seed=0, instrumentation=instrumentation,
+            return_stats=True)
+    expected = match_images(engine, garment, closet)
+    assert (garment_color, matching_colors) == expected[:2]
+    assert np.array_equal(np.asarray(image), expected[2])
+
+    assert hook.requests == [stats]
+    assert set(hook.stages) == set(stats.stages)
+    for name in ('load', 'color_correction', 'segmentation',
+                 'segment_labeling', 'compositing'):
+        assert stats.stages[name]['wall'] >= 0
+        assert stats.stages[name]['peak_alloc'] is not None
+    assert stats.counters['images_loaded'] == 2
+    assert stats.counters['segments'] > 0
+
+
+######################
+### TILED MATCHING ###
+######################
+
+def test_tiled_match_equals_match(color_lut, images, tmpdir):
+
+    # a closet that fits in one tile is matched exactly as it is without
+    # tiles, and the highlighted image is written to the output file
+    garment, closet = images
+    engine = CharmonyEngine(color_lut=color_lut, image_width=closet.shape[1])
+    output_path = str(tmpdir.join('matches.npy'))
+
+    garment_color, matching_colors, image = engine.match_tiled(
+            garment, closet, output_path, seed=0, tile_size=1024)
+    expected = match_images(engine, garment, closet)
+    assert (garment_color, matching_colors) == expected[:2]
+    assert np.array_equal(image, expected[2])
+    assert np.array_equal(np.load(output_path), expected[2])
+
+
+def test_tiled_seams(color_lut, images, tmpdir, monkeypatch):
+
+    # with small tiles, the filtered image joins up exactly, every pixel is
+    # counted once, the segments are numbered 0..n-1, and the temporary
+    # folder is removed
+    closet = images[1]
+    engine = CharmonyEngine(color_lut=color_lut, image_width=closet.shape[1])
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir))
+
+    whole = engine.analyze_closet_tiled(closet, tile_size=1024)
+    instrumentation = Instrumentation()
+    tiled = engine.analyze_closet_tiled(closet, tile_size=200,
+                                        instrumentation=instrumentation)
+    assert np.array_equal(tiled.image, whole.image)
+    assert tiled.segment_colors.histograms.sum() == closet.shape[0] * \
+        closet.shape[1]
+    segment_map = np.asarray(tiled.segment_map)
+    assert np.array_equal(np.unique(segment_map),
+                          np.arange(len(tiled.segment_colors.segment_ids)))
+    assert tmpdir.listdir() == []
+
+    # segments cut by the seams are merged, so their colors mostly agree
+    # with the untiled segments'
+    assert instrumentation.stats.counters['seam_merges'] > 0
+    agreement = np.mean(
+            tiled.segment_colors.color_ids[segment_map] ==
+            whole.segment_colors.color_ids[np.asarray(whole.segment_map)])
+    assert agreement > 0.9
+
+
+######################
+### FRAME MATCHING ###
+######################
+
+def test_frame_matching(color_lut, images):
+
+    # the first frame is matched as a still image. A repeated frame is
+    # reused whole, a small change is re-segmented locally (keeping the
+    # other segments, and the labels compact), and a camera shift is
+    # followed without a new keyframe
+    garment, closet = images
+    engine = CharmonyEngine(color_lut=color_lut)
+    patched = closet.copy()
+    patched[90:150, 180:300] = (255, 0, 255)
+    shifted = np.roll(closet, (9, 18), axis=(0, 1))
+
+    instrumentation = Instrumentation()
+    first, repeated, patched_match, shifted_match = match_frames(
+            engine, garment, [closet, closet, patched, shifted], seed=0,
+            instrumentation=instrumentation)
+    expected = match_images(engine, garment, closet)
+    assert (first.garment_color, first.matching_colors) == expected[:2]
+    assert np.array_equal(first.image, expected[2])
+    assert [frame.keyframe for frame in (first, repeated, patched_match,
+                                         shifted_match)] == \
+        [True, False, False, False]
+    assert repeated.changed_fraction == 0
+    assert 0 < patched_match.changed_fraction < 0.1
+    assert instrumentation.stats.counters['shifted_frames'] == 1
+
+    tracker = FrameTracker(engine)
+    segment_map = tracker.update(closet)[1].copy()
+    assert np.array_equal(tracker.update(closet)[1], segment_map)
+    patched_map = tracker.update(patched)[1]
+    assert np.array_equal(np.unique(patched_map),
+                          np.arange(patched_map.max() + 1))
+
+    # below the change, each segment keeps its pixels under its new label
+    below = segment_map[200:] * (patched_map.max() + 1) + patched_map[200:]
+    assert len(np.unique(below)) == len(np.unique(segment_map[200:]))
+
+
+######################
+### WARDROBE INDEX ###
+######################
+
+def test_wardrobe_index_roundtrip(color_lut, images, tmpdir):
+
+    # a query ranks the photos by the share of them covered by matching
+    # colors, as the engine colors them, and the index survives reopening.
+    # Unchanged photos aren't indexed again, and removed ones are gone
+    garment, closet = images
+    other = synthetic_closet(600, 400, np.random.RandomState(1))
+    engine = CharmonyEngine(color_lut=color_lut)
+    path = str(tmpdir.join('wardrobe.db'))
+
+    index = WardrobeIndex(path)
+    assert index.add_many([('closet', closet), ('other', other)],
+                          engine) == ['closet', 'other']
+    garment_color, matching_colors, matches = index.query(garment, engine,
+                                                          seed=0)
+    index.close()
+
+    def matched_area(image):
+        analysis = engine.analyze_closet(image)
+        names = segment_color_names(analysis.segment_colors,
+                                    color_lut.class_names)
+        return np.in1d(names[analysis.segment_map], matching_colors).mean()
+
+    assert (garment_color, matching_colors) == match_images(
+            engine, garment, closet)[:2]
+    expected = dict((name, matched_area(image)) for name, image in
+                    (('closet', closet), ('other', other)))
+    assert matches
+    for match in matches:
+        assert match.area_fraction == pytest.approx(expected[match.name])
+    assert [match.area_fraction for match in matches] == sorted(
+            [match.area_fraction for match in matches], reverse=True)
+
+    index = WardrobeIndex(path)
+    assert index.names() == ['closet', 'other']
+    assert index.query(garment, engine, seed=0)[2] == matches
+    assert not index.add('closet', closet, engine)
+    assert index.remove('closet') and not index.remove('closet')
+    assert 'closet' not in index and len(index) == 1
+    assert index.connection.execute(
+            'SELECT COUNT(*) FROM regions JOIN photos USING (photo_id) '
+            'WHERE name = ?', ('closet',)).fetchone()[0] == 0
+    assert 'closet' not in [match.name for match in index.query_colors(
+            color_lut.class_names)]
+    index.close()
+
+
+########################
+### CONCURRENT MATCH ###
+########################
+
+class ThreadHook(InstrumentationHook):
+
+    # the thread each stage finished on
+    def __init__(self):
+        self.threads = {}
+
+    def stage_finished(self, name, record):
+        self.threads.setdefault(name, set()).add(threading.current_thread())
+
+
+@pytest.mark.parametrize('sampling', ['fixed', 'adaptive'])
+def test_concurrent_match_equals_sequential(color_lut, images, sampling):
+
+    # with two threads the garment is analyzed on the helper thread, with
+    # the same result, and closing the engine stops the helper thread
+    garment, closet = images
+    expected = match_images(CharmonyEngine(color_lut=color_lut,
+                                           sampling=sampling),
+                            garment, closet)
+
+    hook = ThreadHook()
+    with CharmonyEngine(color_lut=color_lut, sampling=sampling,
+                        threads=2) as engine:
+        garment_color, matching_colors, image = engine.match(
+                garment, closet, seed=0,
+                instrumentation=Instrumentation([hook]))
+        assert (garment_color, matching_colors) == expected[:2]
+        assert np.array_equal(np.asarray(image), expected[2])
+        assert hook.threads['garment_sampling'] != \
+            set([threading.current_thread()])
+        helper_threads = threading.active_count()
+    assert engine.helper_pool is None
+    assert threading.active_count() < helper_threads
+
+
+######################
+### REGION MERGING ###
+######################
+
+def test_merge_regions():
+
+    # neighbours of the same color merge and pool their votes, while
+    # segments that don't touch, or differ in color, stay apart
+    segment_map = np.array([[0, 1, 2, 7], [0, 1, 2, 7]])
+    segment_colors = summarize_histograms(
+            np.array([0, 1, 2, 7]),
+            np.array([[10, 0], [9, 1], [0, 10], [10, 0]]))
+
+    region_map, region_colors, region_of_segment = merge_regions(
+            segment_map, segment_colors)
+    assert region_map.tolist() == [[0, 0, 1, 2], [0, 0, 1, 2]]
+    assert region_of_segment.tolist() == [0, 0, 1, 2]
+    assert region_colors.histograms.tolist() == [[19, 1], [0, 10], [10, 0]]
+    assert region_colors.color_ids.tolist() == [0, 1, 0]
+
+    region_map = merge_regions(segment_map, segment_colors,
+                               similarity_threshold=0, same_color=False)[0]
+    assert np.all(region_map == 0)
+
+
+def test_engine_merges_regions(color_lut, images):
+
+    # merging leaves fewer regions than segments, with all of their votes
+    closet = images[1]
+    segments = CharmonyEngine(color_lut=color_lut).analyze_closet(closet)
+    regions = CharmonyEngine(color_lut=color_lut,
+                             merge_regions=True).analyze_closet(closet)
+
+    assert len(regions.segment_colors.segment_ids) < \
+        len(segments.segment_colors.segment_ids)
+    assert np.array_equal(regions.segment_colors.histograms.sum(axis=0),
+                          segments.segment_colors.histograms.sum(axis=0))
+    assert np.array_equal(np.unique(regions.segment_map),
+                          regions.segment_colors.segment_ids)
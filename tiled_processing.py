@@ -0,0 +1,326 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Tiled, bounded-memory processing of very large closet images (wide-angle
+shots and stitched panoramas) at full resolution. The image is split into
+overlapping tiles whose size is set by a memory budget. Color correction uses
+one lookup table built from the histograms of all the tiles, so the tiles are
+balanced as one image. Each tile is segmented on its own, optionally several
+at once, and the segments that cover the same pixels where two tiles overlap
+are merged, so labels are consistent across the seams. The corrected image,
+the label map and the highlighted output are memory-mapped .npy files, and
+only a few tiles are in memory at a time, however large the input is.
+"""
+import math
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import cv2
+import numpy as np
+
+from closet_cache import ClosetAnalysis
+from color_correction import (channel_histograms, edge_preserving_filter,
+                              histogram_color_lut)
+from highlight import highlight_segments
+from image_io import load_image, string_types
+from instrumentation import null_instrumentation
+from label_merging import LabelMerger
+from segment_colors import summarize_histograms
+from segmentation import default_segments_per_megapixel, segment_image, \
+    segments_for_area
+
+
+# a rough upper bound on the memory used per tile pixel while a tile is
+# corrected, segmented (SLIC works on float64 Lab copies) and classified.
+# SLIC peaks at about 126 bytes per pixel, and the grid backend at about 52
+bytes_per_pixel = 160
+
+
+#######################
+### SPLITTING TILES ###
+#######################
+
+def tile_size_for_budget(memory_budget, threads=1, overlap=32,
+                         min_tile_size=128):
+
+    # the largest square tile (without its overlap) for which 'threads'
+    # tiles in flight fit in memory_budget bytes. The budget is advisory: it
+    # covers the working memory of the tiles, not the process itself (the
+    # interpreter, libraries and color model), the small per-segment tables,
+    # or the pages of the memory-mapped files, which the OS can reclaim
+    side = int(math.sqrt(memory_budget / float(threads * bytes_per_pixel)))
+    return max(side - 2 * overlap, min_tile_size)
+
+
+def tile_grid(height, width, tile_size, overlap):
+
+    # split the image into tiles in row-major order. Each tile is a pair of
+    # (top, bottom, left, right) boxes: its core, which tiles the image
+    # without gaps or overlaps, and the core grown by 'overlap' on each side
+    tiles = []
+    for top in np.arange(0, height, tile_size):
+        for left in np.arange(0, width, tile_size):
+            core = (int(top), int(min(top + tile_size, height)),
+                    int(left), int(min(left + tile_size, width)))
+            outer = (max(core[0] - overlap, 0), min(core[1] + overlap, height),
+                     max(core[2] - overlap, 0), min(core[3] + overlap, width))
+            tiles.append((core, outer))
+
+    return tiles
+
+
+def box_slice(box, origin=(0, 0)):
+
+    # the (rows, columns) slices of a box, relative to an origin
+    top, bottom, left, right = box
+    return (slice(top - origin[0], bottom - origin[0]),
+            slice(left - origin[1], right - origin[1]))
+
+
+def open_closet(closet):
+
+    # large images are best passed as .npy files (or numpy memmaps) of Red
+    # Green Blue pixels, which are read a tile at a time. Any other image is
+    # decoded at full resolution first
+    if isinstance(closet, string_types) and closet.endswith('.npy'):
+        return np.load(closet, mmap_mode='r')
+    if isinstance(closet, np.ndarray) and closet.ndim == 3:
+        return closet
+
+    return load_image(closet, target_width=None, reduced_decode=False)
+
+
+def open_output(path, shape, dtype):
+
+    # a memory-mapped .npy file, which can be reopened with np.load
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                     shape=shape)
+
+
+###############################
+### MERGING LABELS AT SEAMS ###
+###############################
+
+def merge_seam(merger, labels, stitched_labels, merge_fraction=0.5):
+
+    # labels and stitched_labels cover the same pixels, from a new tile and
+    # from the tiles already stitched. Merge each pair of segments whose
+    # shared pixels are at least merge_fraction of the smaller one's pixels
+    # in the overlap
+    labels = labels.ravel().astype(np.int64)
+    stitched_labels = stitched_labels.ravel().astype(np.int64)
+    if not labels.size:
+        return 0
+
+    n_stitched = int(stitched_labels.max()) + 1
+    pair_codes, pair_counts = np.unique(labels * n_stitched + stitched_labels,
+                                        return_counts=True)
+    pairs = np.stack([pair_codes // n_stitched, pair_codes % n_stitched],
+                     axis=1)
+    ids, counts = np.unique(labels, return_counts=True)
+    stitched_ids, stitched_counts = np.unique(stitched_labels,
+                                              return_counts=True)
+    smaller = np.minimum(counts[np.searchsorted(ids, pairs[:, 0])],
+                         stitched_counts[np.searchsorted(stitched_ids,
+                                                         pairs[:, 1])])
+
+    to_merge = pairs[pair_counts >= merge_fraction * smaller]
+    for label, stitched_label in to_merge:
+        merger.union(label, stitched_label)
+
+    return len(to_merge)
+
+
+#########################
+### PROCESSING A TILE ###
+#########################
+
+def process_tile(source, tile, color_correction_lut, color_lut,
+                 edge_filter='bilateral',
+                 segments_per_megapixel=default_segments_per_megapixel,
+                 **segmentation_options):
+
+    # correct, segment and classify one tile. The overlap gives the edge
+    # preserving filter and the segmentation the context around the core
+    core, outer = tile
+    image = np.ascontiguousarray(source[box_slice(outer)])
+    image = edge_preserving_filter(cv2.LUT(image, color_correction_lut),
+                                   edge_filter)
+
+    height, width = image.shape[:2]
+    labels = segment_image(image, n_segments=segments_for_area(
+            height, width, segments_per_megapixel), **segmentation_options)
+
+    # number the labels 0..n-1, and count the colors of each segment within
+    # the core only, so no pixel is counted twice
+    segment_ids, labels = np.unique(labels, return_inverse=True)
+    labels = labels.reshape(height, width).astype(np.int32)
+
+    core_in_tile = box_slice(core, origin=(outer[0], outer[2]))
+    core_image = image[core_in_tile]
+    n_colors = len(color_lut.class_names)
+    joint_index = (labels[core_in_tile].ravel().astype(np.int64) * n_colors +
+                   color_lut.classify_image(core_image).ravel())
+    histograms = np.bincount(
+            joint_index, minlength=len(segment_ids) * n_colors).reshape(
+                    len(segment_ids), n_colors)
+
+    return core_image, labels, histograms
+
+
+###############################
+### ANALYZING A LARGE IMAGE ###
+###############################
+
+def analyze_closet_tiled(closet, color_lut, work_dir=None, tile_size=None,
+                         overlap=32, memory_budget=256 * 2 ** 20, threads=1,
+                         percentile_correction=10, edge_filter='bilateral',
+                         segments_per_megapixel=
+                         default_segments_per_megapixel, merge_fraction=0.5,
+                         instrumentation=null_instrumentation,
+                         **segmentation_options):
+
+    # returns a ClosetAnalysis whose image (the color corrected closet) and
+    # segment_map are memory-mapped files in work_dir. Without a work_dir,
+    # they're made in a temporary folder that's removed straight away: the
+    # arrays keep their (unlinked) files until they're dropped
+    if tile_size is None:
+        tile_size = tile_size_for_budget(memory_budget, threads, overlap)
+
+    # the overlap must cover the edge preserving filter's neighbourhood, so
+    # the filtered tiles join up exactly
+    overlap = max(overlap, 2)
+
+    with instrumentation.stage('load'):
+        source = open_closet(closet)
+    height, width = source.shape[:2]
+    tiles = tile_grid(height, width, tile_size, overlap)
+    instrumentation.gauge('tiles', len(tiles))
+
+    # one color correction for the whole image, from the sum of the tiles'
+    # histograms
+    with instrumentation.stage('color_correction'):
+        histograms = np.zeros((3, 256), dtype=np.int64)
+        for core, _ in tiles:
+            histograms += channel_histograms(
+                    np.ascontiguousarray(source[box_slice(core)]))
+        color_correction_lut = histogram_color_lut(histograms,
+                                                   percentile_correction)
+
+    remove_work_dir = work_dir is None
+    if remove_work_dir:
+        work_dir = tempfile.mkdtemp(prefix='charmony_tiles_')
+    try:
+        corrected = open_output(os.path.join(work_dir, 'corrected.npy'),
+                                (height, width, 3), np.uint8)
+        segment_map = open_output(os.path.join(work_dir, 'segment_map.npy'),
+                                  (height, width), np.int32)
+    finally:
+        if remove_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def process(tile):
+        return process_tile(source, tile, color_correction_lut, color_lut,
+                            edge_filter, segments_per_megapixel,
+                            **segmentation_options)
+
+    # process 'threads' tiles at a time, and stitch them in row-major order,
+    # so the tiles above and to the left of each tile are already stitched
+    merger = LabelMerger()
+    tile_histograms = []
+    pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        with instrumentation.stage('segmentation'):
+            for start in np.arange(0, len(tiles), threads):
+                batch = tiles[start:start + threads]
+                if pool is not None:
+                    results = pool.map(process, batch)
+                else:
+                    results = [process(tile) for tile in batch]
+
+                for (core, outer), (core_image, labels, histograms) in \
+                        zip(batch, results):
+                    labels += merger.add(len(histograms))
+                    tile_histograms.append(histograms)
+
+                    # the strip above the core, and the strip to the left of
+                    # it, are covered by the cores of stitched tiles
+                    seams = [(outer[0], core[0], outer[2], outer[3]),
+                             (core[0], core[1], outer[2], core[2])]
+                    for seam in seams:
+                        instrumentation.count('seam_merges', merge_seam(
+                                merger,
+                                labels[box_slice(seam, (outer[0], outer[2]))],
+                                segment_map[box_slice(seam)],
+                                merge_fraction))
+
+                    corrected[box_slice(core)] = core_image
+                    segment_map[box_slice(core)] = labels[box_slice(
+                            core, (outer[0], outer[2]))]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    with instrumentation.stage('segment_labeling'):
+        # pool the color counts of merged segments, and renumber the merged
+        # segments that have pixels 0..n-1
+        groups, group_index = np.unique(merger.roots(), return_inverse=True)
+        tile_histograms = np.concatenate(tile_histograms)
+        histograms = np.zeros((len(groups), tile_histograms.shape[1]),
+                              dtype=np.int64)
+        np.add.at(histograms, group_index, tile_histograms)
+
+        has_pixels = histograms.sum(axis=1) > 0
+        new_labels = (np.cumsum(has_pixels) - 1)[group_index].astype(np.int32)
+        histograms = histograms[has_pixels]
+
+        for core, _ in tiles:
+            segment_map[box_slice(core)] = new_labels[
+                    segment_map[box_slice(core)]]
+        segment_map.flush()
+        corrected.flush()
+
+        segment_colors = summarize_histograms(np.arange(len(histograms)),
+                                              histograms)
+    instrumentation.count('pixels_classified', height * width)
+    instrumentation.count('segments', len(histograms))
+
+    return ClosetAnalysis(corrected, segment_map, segment_colors)
+
+
+def highlight_tiled(analysis, segments_to_highlight, output_path, tile_size,
+                    threads=1, **style):
+
+    # highlight a tiled analysis into a memory-mapped .npy file, a tile at a
+    # time. An outline needs the pixels around each tile to erode the mask
+    height, width = analysis.segment_map.shape
+    overlap = style.get('outline_width', 2) + 1 \
+        if style.get('outline_color') is not None else 0
+    output = open_output(output_path, (height, width, 3), np.uint8)
+
+    def highlight(tile):
+        core, outer = tile
+        highlighted = highlight_segments(
+                analysis.image[box_slice(outer)],
+                analysis.segment_map[box_slice(outer)],
+                segments_to_highlight, **style)
+        output[box_slice(core)] = highlighted[box_slice(
+                core, (outer[0], outer[2]))]
+
+    tiles = tile_grid(height, width, tile_size, overlap)
+    if threads > 1:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(highlight, tiles)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for tile in tiles:
+            highlight(tile)
+    output.flush()
+
+    return output
@@ -0,0 +1,267 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+A persistent, wardrobe-wide color index. Each closet (or garment) photo is
+segmented and labeled once when it's added, and the color, area and bounding
+box of every segment are stored in a local SQLite database. Photos can be
+added, replaced and removed one at a time. A query works out the garment's
+color and its matching colors (by rotating the color wheel, as usual), and
+ranks every indexed photo by the share of it covered by matching colors with
+a single index lookup, instead of re-analyzing every closet photo.
+
+    python wardrobe_index.py wardrobe.db add closet1.jpg closet2.jpg
+    python wardrobe_index.py wardrobe.db query garment.jpg --method triad
+    python wardrobe_index.py wardrobe.db remove closet1.jpg
+"""
+import json
+import sqlite3
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from closet_cache import image_digest
+from instrumentation import null_instrumentation
+from match_result import segment_boxes
+from segment_colors import segment_color_names
+
+
+# name: the name the photo was added under
+# area_fraction: the share of the photo covered by matching colors
+# n_regions: the number of matching segments
+# regions: (segment_id, color, (top, left, bottom, right), area_fraction)
+#          of each matching segment, largest first (if asked for)
+WardrobeMatch = namedtuple('WardrobeMatch', ['name', 'area_fraction',
+                                             'n_regions', 'regions'])
+
+schema = '''
+CREATE TABLE IF NOT EXISTS photos (
+    photo_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    digest TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    height INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS regions (
+    photo_id INTEGER NOT NULL REFERENCES photos (photo_id) ON DELETE CASCADE,
+    segment_id INTEGER NOT NULL,
+    color TEXT NOT NULL,
+    area_fraction REAL NOT NULL,
+    vote_fraction REAL NOT NULL,
+    bbox_top INTEGER NOT NULL,
+    bbox_left INTEGER NOT NULL,
+    bbox_bottom INTEGER NOT NULL,
+    bbox_right INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS regions_by_color ON regions (color, photo_id);
+'''
+
+
+def photo_regions(closet_analysis, class_names):
+
+    # a (segment_id, color, area_fraction, vote_fraction, top, left, bottom,
+    # right) row for every segment that has a color
+    segment_map = np.asarray(closet_analysis.segment_map)
+    segment_colors = closet_analysis.segment_colors
+    names = segment_color_names(segment_colors, class_names)
+    areas = np.bincount(segment_map.ravel(),
+                        minlength=int(segment_colors.segment_ids.max()) + 1)
+    boxes = segment_boxes(segment_map, segment_colors.segment_ids)
+
+    return [(int(segment_id), name,
+             float(areas[segment_id]) / segment_map.size,
+             float(vote_fraction)) + tuple(int(side) for side in box)
+            for segment_id, name, vote_fraction, box in
+            zip(segment_colors.segment_ids, names,
+                segment_colors.vote_fractions, boxes)
+            if name is not None and box is not None]
+
+
+class WardrobeIndex(object):
+
+    def __init__(self, path=':memory:'):
+
+        # path: the SQLite database file (created if it doesn't exist)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute(
+                'SELECT COUNT(*) FROM photos').fetchone()[0]
+
+    def __contains__(self, name):
+        return self.connection.execute(
+                'SELECT 1 FROM photos WHERE name = ?', (name,)).fetchone() \
+            is not None
+
+    def names(self):
+        return [row[0] for row in self.connection.execute(
+                'SELECT name FROM photos ORDER BY photo_id')]
+
+    #####################
+    ### ADDING PHOTOS ###
+    #####################
+
+    def add(self, name, image, engine, instrumentation=null_instrumentation):
+
+        # segment and label a photo with the engine, and store its regions
+        # under name. A photo already indexed with the same content and
+        # engine parameters is skipped, and a changed one is replaced.
+        # Returns whether the photo was (re)indexed
+        image = engine.read_image(image)
+        digest = image_digest(image)
+        parameters = json.dumps(engine.closet_parameters(), sort_keys=True)
+
+        row = self.connection.execute(
+                'SELECT digest, parameters FROM photos WHERE name = ?',
+                (name,)).fetchone()
+        if row is not None and tuple(row) == (digest, parameters):
+            return False
+
+        analysis = engine.analyze_closet(image, instrumentation)
+        regions = photo_regions(analysis, engine.color_detector.class_names)
+        height, width = np.shape(analysis.segment_map)
+
+        with self.connection:
+            self.connection.execute('DELETE FROM photos WHERE name = ?',
+                                    (name,))
+            photo_id = self.connection.execute(
+                    'INSERT INTO photos (name, digest, parameters, height, '
+                    'width, added) VALUES (?, ?, ?, ?, ?, ?)',
+                    (name, digest, parameters, height, width,
+                     time.time())).lastrowid
+            self.connection.executemany(
+                    'INSERT INTO regions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(photo_id,) + region for region in regions])
+
+        return True
+
+    def add_many(self, photos, engine):
+
+        # add (name, image) pairs (or file paths, named after themselves),
+        # returning the names that were (re)indexed
+        indexed = []
+        for photo in photos:
+            name, image = (photo, photo) if not isinstance(photo, tuple) \
+                else photo
+            if self.add(name, image, engine):
+                indexed.append(name)
+
+        return indexed
+
+    def remove(self, name):
+
+        # remove a photo and its regions, returning whether it was indexed
+        with self.connection:
+            return self.connection.execute(
+                    'DELETE FROM photos WHERE name = ?', (name,)).rowcount > 0
+
+    def stale(self, engine):
+
+        # the photos indexed with other engine parameters (e.g. another
+        # model), which need adding again to be comparable
+        parameters = json.dumps(engine.closet_parameters(), sort_keys=True)
+        return [row[0] for row in self.connection.execute(
+                'SELECT name FROM photos WHERE parameters != ?',
+                (parameters,))]
+
+    #######################
+    ### QUERYING COLORS ###
+    #######################
+
+    def query_colors(self, colors, limit=None, with_regions=False,
+                     min_area_fraction=0.0):
+
+        # rank the photos by the share of their area covered by segments of
+        # the given colors
+        colors = list(colors)
+        if not colors:
+            return []
+
+        placeholders = ', '.join('?' * len(colors))
+        rows = self.connection.execute(
+                'SELECT photos.photo_id, name, SUM(area_fraction) AS matched, '
+                'COUNT(*) FROM regions JOIN photos USING (photo_id) '
+                'WHERE color IN (%s) GROUP BY photos.photo_id '
+                'HAVING matched >= ? ORDER BY matched DESC, name '
+                'LIMIT ?' % placeholders,
+                colors + [min_area_fraction,
+                          -1 if limit is None else limit]).fetchall()
+
+        matches = []
+        for photo_id, name, matched, n_regions in rows:
+            regions = None
+            if with_regions:
+                regions = [(segment_id, color, (top, left, bottom, right),
+                            area_fraction)
+                           for segment_id, color, area_fraction, top, left,
+                           bottom, right in self.connection.execute(
+                                   'SELECT segment_id, color, area_fraction, '
+                                   'bbox_top, bbox_left, bbox_bottom, '
+                                   'bbox_right FROM regions '
+                                   'WHERE photo_id = ? AND color IN (%s) '
+                                   'ORDER BY area_fraction DESC'
+                                   % placeholders, [photo_id] + colors)]
+            matches.append(WardrobeMatch(name, matched, n_regions, regions))
+
+        return matches
+
+    def query(self, garment, engine, method='complement', seed=None,
+              limit=None, with_regions=False, min_area_fraction=0.0):
+
+        # the garment's color, its matching colors (by the 'complement' or
+        # 'triad' rule), and the indexed photos ranked by matched area
+        garment_color = engine.analyze_garment(garment, seed)
+        matching_colors = engine.matching_colors(garment_color, method)
+
+        return garment_color, matching_colors, self.query_colors(
+                matching_colors, limit, with_regions, min_area_fraction)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from charmony_engine import CharmonyEngine
+
+    parser = argparse.ArgumentParser(description='Index closet photos by '
+                                                 'color, and query them.')
+    parser.add_argument('database', help='the SQLite index file')
+    parser.add_argument('command', choices=['add', 'remove', 'query', 'list'])
+    parser.add_argument('images', nargs='*')
+    parser.add_argument('--method', default='complement',
+                        choices=['complement', 'triad'])
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--model-path', default='color_detector.pkl')
+    args = parser.parse_args()
+
+    index = WardrobeIndex(args.database)
+    if args.command == 'list':
+        for name in index.names():
+            print(name)
+    elif args.command == 'remove':
+        for name in args.images:
+            print('%s: %s' % (name, 'removed' if index.remove(name)
+                              else 'not indexed'))
+    else:
+        engine = CharmonyEngine(args.model_path)
+        if args.command == 'add':
+            indexed = index.add_many(args.images, engine)
+            print('indexed %d of %d photos' % (len(indexed),
+                                               len(args.images)))
+        else:
+            for garment in args.images:
+                garment_color, matching_colors, matches = index.query(
+                        garment, engine, args.method, limit=args.limit)
+                print('%s is %s, matching %s' %
+                      (garment, garment_color, ', '.join(matching_colors)))
+                for match in matches:
+                    print('  %6.1f%% %s (%d regions)' %
+                          (100 * match.area_fraction, match.name,
+                           match.n_regions))
+    index.close()